@@ -0,0 +1,390 @@
+"""
+catalog of the downloaded files of a product
+what does it do?
+ - parses each file name once into product, scene id, tile, collection
+   and production timestamp
+ - groups files by scene in a dictionary, so the files of a scene and the
+   number of files of each scene are found without scanning the file list
+ - gives the complete, incomplete and overpopulated scenes of products
+   with a fixed number of files per scene (e.g. the nine HidroCL MODIS tiles)
+ - resolves duplicated granules (the same scene and tile reprocessed with
+   another production timestamp) keeping the newest one, and moves the
+   others to a quarantine folder or deletes them
+ - keeps a persistent SQLite catalog of product folders (name, size, mtime,
+   parsed fields, date and validation status of each file). A folder is
+   listed again only when its mtime changes, and downloaders add each file
+   they finish, so extractors and downloaders don't list large folders
+"""
+
+import os
+import re
+import shutil
+import sqlite3
+from pathlib import Path
+from datetime import datetime
+from collections import namedtuple
+
+ProductFile = namedtuple('ProductFile', ['name', 'product', 'scene', 'tile', 'collection', 'production'])
+
+modis_tile = re.compile(r'h\d{2}v\d{2}')
+
+
+def parse_name(name):
+    """parse a product file name into a ProductFile
+
+    MODIS names (MOD13Q1.A2000049.h11v10.061.2020048094547.hdf) give every
+    field. IMERG names (3B-HHR.MS.MRG.3IMERG.20000601-S000000-E002959.0000.V06B.HDF5)
+    give the day as scene and the half hour as tile. For other names the
+    scene is the second field split by dots and the rest is None"""
+    parts = name.split('.')
+    if len(parts) >= 6 and modis_tile.fullmatch(parts[2]):
+        return ProductFile(name, parts[0], parts[1], parts[2], parts[3], parts[4])
+    if len(parts) >= 7 and parts[3] == '3IMERG':
+        return ProductFile(name, parts[0], parts[4].split('-')[0], parts[5], parts[6], None)
+    return ProductFile(name, parts[0], parts[1] if len(parts) > 1 else None, None, None, None)
+
+
+def scene_date(scene):
+    """date of a scene id as YYYY-MM-DD: AYYYYDDD (MODIS), AYYYYMMDD (GLDAS) or YYYYMMDD (IMERG).
+    None for other ids"""
+    if scene is None:
+        return None
+    for pattern, date_format in ((r'A\d{7}', 'A%Y%j'), (r'A\d{8}', 'A%Y%m%d'), (r'\d{8}', '%Y%m%d')):
+        if re.fullmatch(pattern, scene):
+            try:
+                return datetime.strptime(scene, date_format).strftime('%Y-%m-%d')
+            except ValueError:
+                return None
+    return None
+
+
+class ProductCatalog:
+    """A class to hold the files of a product grouped by scene
+
+    Parameters:
+    files (list): file names
+    folder (str): folder of the files, joined to the names of scene_files
+    files_per_scene (int): files of a complete scene"""
+
+    def __init__(self, files, folder=None, files_per_scene=9):
+        self.folder = folder
+        self.files_per_scene = files_per_scene
+        self.scenes = {}
+        for name in files:
+            self.add(name)
+
+    def __repr__(self):
+        return f'Product catalog with {len(self)} files in {len(self.scenes)} scenes'
+
+    def __len__(self):
+        return sum(len(records) for records in self.scenes.values())
+
+    def __contains__(self, scene):
+        return scene in self.scenes
+
+    def add(self, name):
+        """parse a file name and add it to its scene"""
+        record = parse_name(name)
+        self.scenes.setdefault(record.scene, []).append(record)
+        return record
+
+    def remove(self, name):
+        """remove a file name from its scene"""
+        record = parse_name(name)
+        records = [value for value in self.records(record.scene) if value.name != name]
+        if records:
+            self.scenes[record.scene] = records
+        else:
+            self.scenes.pop(record.scene, None)
+
+    def names(self):
+        """file names of every scene"""
+        return [record.name for records in self.scenes.values() for record in records]
+
+    def scene_ids(self):
+        """sorted scene ids"""
+        return sorted(self.scenes)
+
+    def records(self, scene):
+        """parsed files of a scene"""
+        return self.scenes.get(scene, [])
+
+    def scene_files(self, scene):
+        """paths of the files of a scene, sorted by name"""
+        names = sorted(record.name for record in self.records(scene))
+        if self.folder is None:
+            return names
+        return [os.path.join(self.folder, name) for name in names]
+
+    def occurrences(self):
+        """number of files of each scene, as a dictionary sorted by scene"""
+        return {scene: len(self.scenes[scene]) for scene in self.scene_ids()}
+
+    def complete_scenes(self):
+        """scenes with files_per_scene files"""
+        return [scene for scene, count in self.occurrences().items() if count == self.files_per_scene]
+
+    def incomplete_scenes(self):
+        """scenes with less than files_per_scene files"""
+        return [scene for scene, count in self.occurrences().items() if count < self.files_per_scene]
+
+    def overpopulated_scenes(self):
+        """scenes with more than files_per_scene files"""
+        return [scene for scene, count in self.occurrences().items() if count > self.files_per_scene]
+
+    def superseded(self):
+        """files with the same product, scene, tile and extension as a file of a newer production timestamp
+
+        Returns:
+        dict: scene -> superseded file names"""
+        superseded = {}
+        for scene, records in self.scenes.items():
+            newest = {}
+            for record in records:
+                if record.tile is None or record.production is None:
+                    continue
+                # files of other products or extensions (e.g. .hdf.xml) are not duplicates
+                key = (record.product, record.tile, record.name.split('.', 5)[-1])
+                if key not in newest or record.production > newest[key].production:
+                    if key in newest:
+                        superseded.setdefault(scene, []).append(newest[key].name)
+                    newest[key] = record
+                else:
+                    superseded.setdefault(scene, []).append(record.name)
+        return superseded
+
+
+def quarantine_folder(folder):
+    """set quarantine folder of a product folder. It is inside the product folder,
+    so files are moved by renaming them"""
+    quarantine_path = os.path.join(folder, 'quarantine')
+    if not os.path.exists(quarantine_path):
+        os.makedirs(quarantine_path, exist_ok=True)
+        print(f'Quarantine folder {quarantine_path} not found, creating it')
+    return quarantine_path
+
+
+def quarantine_files(folder, names, delete=False, files_catalog=None):
+    """move files of a product folder to its quarantine folder, or delete them, in one batch
+
+    Parameters:
+    folder (str): product folder
+    names (list): file names
+    delete (bool): delete the files instead of moving them
+    files_catalog (FileCatalog): file catalog where the files are dropped"""
+    if len(names) == 0:
+        return
+    quarantine_path = None if delete else quarantine_folder(folder)
+    for name in names:
+        path = os.path.join(folder, name)
+        if delete:
+            os.remove(path)
+        else:
+            shutil.move(path, os.path.join(quarantine_path, name))
+        if files_catalog is not None:
+            files_catalog.remove_file(path)
+    print(f'{"Deleted" if delete else "Moved to quarantine"} {len(names)} files of {folder}')
+
+
+def resolve_duplicates(product_catalog, delete=False, database=None):
+    """keep the newest production timestamp of each scene and tile of a product catalog
+
+    Superseded files are moved to the quarantine folder (or deleted) and
+    removed from the catalog, so their scenes can be complete again
+
+    Parameters:
+    product_catalog (ProductCatalog): catalog of a product folder
+    delete (bool): delete superseded files instead of moving them
+    database (str): file catalog database. Default is ~/catalogHidroCL/files.sqlite
+
+    Returns:
+    list: scenes with superseded files"""
+    superseded = product_catalog.superseded()
+    names = [name for scene in sorted(superseded) for name in superseded[scene]]
+    if len(names) == 0:
+        return []
+    with FileCatalog(database) as files_catalog:
+        quarantine_files(product_catalog.folder, names, delete, files_catalog)
+    for name in names:
+        product_catalog.remove(name)
+    for scene in sorted(superseded):
+        print(f'Scene {scene}: kept {len(product_catalog.records(scene))} files, '
+              f'removed {len(superseded[scene])} superseded files')
+    return sorted(superseded)
+
+
+def resolve_folder_duplicates(folder, delete=False, database=None):
+    """resolve_duplicates over every file of a product folder"""
+    return resolve_duplicates(ProductCatalog(list_files(folder, database=database), folder), delete, database)
+
+
+def catalog_path():
+    """set path of the file catalog database, ~/catalogHidroCL/files.sqlite"""
+    home = str(Path.home())  # get user's home path
+    catalog_folder = os.path.join(home, 'catalogHidroCL')
+
+    if not os.path.exists(catalog_folder):
+        os.makedirs(catalog_folder, exist_ok=True)
+        print(f'Catalog folder {catalog_folder} not found, creating it')
+    return os.path.join(catalog_folder, 'files.sqlite')
+
+
+class FileCatalog:
+    """A class to hold a persistent SQLite catalog of product folders
+
+    Each file is recorded with its name, size, mtime, parsed product, scene,
+    tile, collection and production timestamp, scene date and validation
+    status. update lists a folder only when its mtime differs from the last
+    listing. add_file records a single file, and given the folder mtime from
+    before the file was written, keeps the folder current, so the folder is
+    never listed to learn about a file just downloaded.
+
+    Parameters:
+    database (str): SQLite file. Default is ~/catalogHidroCL/files.sqlite"""
+
+    def __init__(self, database=None):
+        self.database = catalog_path() if database is None else database
+        self.connection = sqlite3.connect(self.database, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, mtime REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                    'folder TEXT, name TEXT, size INTEGER, mtime REAL, product TEXT, '
+                                    'scene TEXT, tile TEXT, collection TEXT, production TEXT, date TEXT, '
+                                    "status TEXT DEFAULT 'unchecked', PRIMARY KEY (folder, name))")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS files_scene ON files (folder, scene)')
+
+    def __repr__(self):
+        return f'File catalog at {self.database}'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """close the database connection"""
+        self.connection.close()
+
+    @staticmethod
+    def row(folder, name, size, mtime):
+        """values of a files row, with the parsed fields of the name"""
+        record = parse_name(name)
+        return (folder, name, size, mtime, record.product, record.scene, record.tile, record.collection,
+                record.production, scene_date(record.scene))
+
+    def upsert(self, rows):
+        """insert or replace files rows. The status is reset, as the file may have changed"""
+        self.connection.executemany('INSERT OR REPLACE INTO files (folder, name, size, mtime, product, scene, '
+                                    'tile, collection, production, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    rows)
+
+    def update(self, folder):
+        """list a folder again if its mtime changed since the last listing
+
+        Only new files are read with stat, as product files are not rewritten
+        in place. Files no longer in the folder are dropped and the others
+        keep their record and validation status
+
+        Returns:
+        bool: True if the folder was listed"""
+        folder = os.path.abspath(folder)
+        mtime = os.stat(folder).st_mtime
+        known = self.connection.execute('SELECT mtime FROM folders WHERE folder = ?', (folder,)).fetchone()
+        if known is not None and known[0] == mtime:
+            return False
+        recorded = {name for (name,) in self.connection.execute('SELECT name FROM files WHERE folder = ?',
+                                                                (folder,))}
+        rows = []
+        present = set()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                present.add(entry.name)
+                if entry.name not in recorded:
+                    stat = entry.stat()
+                    rows.append(self.row(folder, entry.name, stat.st_size, stat.st_mtime))
+        removed = [(folder, name) for name in recorded - present]
+        with self.connection:
+            self.upsert(rows)
+            self.connection.executemany('DELETE FROM files WHERE folder = ? AND name = ?', removed)
+            self.connection.execute('INSERT OR REPLACE INTO folders VALUES (?, ?)', (folder, mtime))
+        print(f'Catalog of {folder}: {len(rows)} new and {len(removed)} removed files')
+        return True
+
+    def folder_mtime(self, folder):
+        """mtime of a folder, to give to add_file after writing a file in it. None if it does not exist"""
+        folder = os.path.abspath(folder)
+        return os.stat(folder).st_mtime if os.path.isdir(folder) else None
+
+    def add_file(self, path, folder_mtime=None):
+        """record a single file, e.g. when a download finishes
+
+        Parameters:
+        path (str): file
+        folder_mtime (float): mtime of the folder before the file was written. If
+        the catalog had recorded that mtime, only this file changed the folder,
+        so its new mtime is recorded and the folder is not listed again"""
+        folder, name = os.path.split(os.path.abspath(path))
+        stat = os.stat(path)
+        with self.connection:
+            self.upsert([self.row(folder, name, stat.st_size, stat.st_mtime)])
+            if folder_mtime is not None:
+                self.connection.execute('UPDATE folders SET mtime = ? WHERE folder = ? AND mtime = ?',
+                                        (os.stat(folder).st_mtime, folder, folder_mtime))
+
+    def remove_file(self, path):
+        """drop a single file, e.g. when it is moved or deleted"""
+        folder, name = os.path.split(os.path.abspath(path))
+        with self.connection:
+            self.connection.execute('DELETE FROM files WHERE folder = ? AND name = ?', (folder, name))
+
+    def files(self, folder, extension=None, update=True):
+        """names of the files of a folder, optionally only those containing extension (e.g. '.hdf')"""
+        folder = os.path.abspath(folder)
+        if update:
+            self.update(folder)
+        names = [name for (name,) in self.connection.execute('SELECT name FROM files WHERE folder = ? '
+                                                             'ORDER BY name', (folder,))]
+        if extension is None:
+            return names
+        return [name for name in names if extension in name]
+
+    def latest_date(self, folder, extension=None, update=True):
+        """most recent scene date of a folder as YYYY-MM-DD, None if there is none"""
+        folder = os.path.abspath(folder)
+        if update:
+            self.update(folder)
+        query = 'SELECT MAX(date) FROM files WHERE folder = ?'
+        parameters = [folder]
+        if extension is not None:
+            query += " AND instr(lower(name), ?) > 0"
+            parameters.append(extension.lower())
+        return self.connection.execute(query, parameters).fetchone()[0]
+
+    def fingerprints(self, folder):
+        """recorded size, mtime and validation status of the files of a folder
+
+        Returns:
+        dict: name -> (size, mtime, status)"""
+        return {name: (size, mtime, status) for name, size, mtime, status in
+                self.connection.execute('SELECT name, size, mtime, status FROM files WHERE folder = ?',
+                                        (os.path.abspath(folder),))}
+
+    def set_statuses(self, folder, statuses):
+        """set the validation status of several files of a folder in one transaction
+
+        Parameters:
+        folder (str): folder of the files
+        statuses (list): (name, status) pairs"""
+        folder = os.path.abspath(folder)
+        with self.connection:
+            self.connection.executemany('UPDATE files SET status = ? WHERE folder = ? AND name = ?',
+                                        [(status, folder, name) for name, status in statuses])
+
+
+def list_files(folder, extension=None, database=None):
+    """names of the files of a product folder from the file catalog, as os.listdir with an extension filter"""
+    with FileCatalog(database) as files_catalog:
+        return files_catalog.files(folder, extension)
@@ -0,0 +1,439 @@
+"""
+fixed grid mosaics for the HidroCL MODIS tiles
+what does it do?
+ - the nine HidroCL tiles and the MODIS sinusoidal grid never change, so
+   the canvas geometry and the window of each tile are computed once per
+   resolution instead of working out bounds with merge_arrays every scene
+ - keeps one output buffer per resolution and writes each decoded tile
+   straight into its slice
+ - several products of a scene (e.g. NDVI, EVI and NBR) can be built
+   together, opening each tile and reading each layer once
+ - layers are opened directly through their GDAL subdataset path, so the
+   other layers of the HDF container are never opened. Subdataset names
+   are looked up once per product and layer
+ - tiles can be decoded on a pool of threads, each with its own dataset
+   handles, writing into disjoint slices of the canvas
+ - with a memory budget, mosaics are dask-backed arrays of row blocks,
+   read and combined only when each block is computed, so band math,
+   raster writing and hidrocl_zonal statistics stream block by block
+ - partials reduces a scene tile by tile to hidrocl_zonal partial
+   aggregates, without building the mosaic. Peak memory is one tile and
+   tiles can be processed in parallel
+ - canvases can have an integer type (e.g. the int16 of MOD13Q1 and
+   MCD43A3 or the uint8 of MOD10A2) with a nodata value instead of nan, to
+   keep mosaics as compact as the source. Scale factors are left to the
+   statistics
+ - with a footprint, the canvas is reduced to the bounding box of the
+   catchments plus a buffer, and only the rows and columns of each tile
+   inside it are read. Tiles out of the footprint are not opened
+"""
+
+import os
+import re
+import operator
+import rasterio
+import numpy as np
+import xarray as xr
+import dask
+import dask.array as da
+import geopandas as gpd
+import rioxarray as rioxr
+from math import floor, ceil
+from functools import reduce
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from rasterio.transform import Affine
+
+import hidrocl_zonal as zonal
+
+modis_tiles = ['h13v14', 'h14v14', 'h12v13', 'h13v13', 'h11v12',
+               'h12v12', 'h11v11', 'h12v11', 'h11v10']
+
+tile_length = 1111950.5196666666  # tile side in meters
+grid_origin = (-20015109.354, 10007554.677)  # upper left corner of tile h00v00
+
+_subdataset_templates = {}
+
+
+def tile_name(raster):
+    """return the hXXvYY tile of a MODIS file name"""
+    match = re.search(r'h\d\dv\d\d', os.path.basename(raster))
+    if match is None:
+        raise ValueError(f'No MODIS tile in {raster}')
+    return match.group(0)
+
+
+def subdataset_path(raster, layer):
+    """return the GDAL subdataset path of a layer of a MODIS file
+
+    The subdataset list of the first file of a product is searched once, and
+    the path is kept as a template for the other files of the same product"""
+    key = (os.path.basename(raster).split('.')[0], layer)
+    if key not in _subdataset_templates:
+        with rasterio.open(raster) as src:
+            names = [name for name in src.subdatasets if name.rsplit(':', 1)[-1].strip('/') == layer]
+        if len(names) == 0 or raster not in names[0]:
+            raise ValueError(f'No subdataset {layer} in {raster}')
+        _subdataset_templates[key] = names[0].replace(raster, '{path}')
+    return _subdataset_templates[key].replace('{path}', raster)
+
+
+def open_layer(raster, layer):
+    """open a layer of a MODIS file as a lazy rioxarray array, without opening the other layers"""
+    return rioxr.open_rasterio(subdataset_path(raster, layer), masked=True, cache=False)
+
+
+def fill_value(dtype):
+    """nodata of a canvas type: nan for floats, the lowest value of signed and the highest of unsigned integers"""
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        return np.nan
+    if np.issubdtype(dtype, np.signedinteger):
+        return np.iinfo(dtype).min
+    return np.iinfo(dtype).max
+
+
+def encode(values, dtype):
+    """cast tile values to a canvas type. For integer canvases, nan becomes nodata and values are truncated"""
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        return values
+    return np.where(np.isnan(values), fill_value(dtype), np.trunc(values)).astype(dtype)
+
+
+def read_window(raster, layers, tile_rows, tile_cols):
+    """read the same window of several layers of a MODIS file
+
+    Returns:
+    dict: layer -> array"""
+    with ExitStack() as stack:
+        data = {layer: stack.enter_context(open_layer(raster, layer)) for layer in layers}
+        # lazy arrays: only the window is read from the file
+        return {layer: lyr[0, tile_rows, tile_cols].values for layer, lyr in data.items()}
+
+
+def read_blocks(tiles, products, row0, row1, width, dtype):
+    """read canvas rows row0 to row1 of several products, reading each layer of each tile once
+
+    Parameters:
+    tiles (list): (MODIS file, window) of the tiles in the canvas, windows as in ModisMosaic.grid
+    products (dict): product name -> (layers, function), as in ModisMosaic.build
+    row0 (int): first canvas row
+    row1 (int): canvas row after the last one
+    width (int): canvas columns
+    dtype (str): block data type
+
+    Returns:
+    dict: product name -> block"""
+    layers = list(dict.fromkeys(layer for product_layers, function in products.values()
+                                for layer in product_layers))
+    blocks = {product: np.full((row1 - row0, width), fill_value(dtype), dtype=dtype) for product in products}
+    for raster, (tile_rows, tile_cols, rows, cols) in tiles:
+        r0, r1 = max(rows.start, row0), min(rows.stop, row1)
+        if r1 <= r0:
+            continue
+        offset = tile_rows.start - rows.start
+        values = read_window(raster, layers, slice(r0 + offset, r1 + offset), tile_cols)
+        for product, (product_layers, function) in products.items():
+            product_values = [values[layer] for layer in product_layers]
+            blocks[product][r0 - row0:r1 - row0, cols] = encode(product_values[0] if function is None
+                                                                else function(*product_values), dtype)
+    return blocks
+
+
+def tile_partials(raster, products, polygons_paths, tile_grid, crs, sketch=False):
+    """compute the zonal partials of the products of one tile
+
+    Parameters:
+    raster (str): MODIS file of the tile
+    products (dict): product name -> (layers, function), as in ModisMosaic.build
+    polygons_paths (list): polygon files
+    tile_grid (tuple): transform, shape and tile rows and columns, from ModisMosaic.tile_grid
+    crs: raster crs
+    sketch (bool): keep quantile sketches
+
+    Returns:
+    dict: product name -> list of hidrocl_zonal.ZonalPartials, one per polygon file"""
+    transform, shape, tile_rows, tile_cols = tile_grid
+    layers = list(dict.fromkeys(layer for product_layers, function in products.values()
+                                for layer in product_layers))
+    values = read_window(raster, layers, tile_rows, tile_cols)
+    weights_list = [zonal.get_weights(polygons_path, transform, shape, crs) for polygons_path in polygons_paths]
+    partials = {}
+    for product, (product_layers, function) in products.items():
+        product_values = [values[layer] for layer in product_layers]
+        product_values = product_values[0] if function is None else function(*product_values)
+        partials[product] = [zonal.zonal_partials(weights, product_values, sketch) for weights in weights_list]
+    return partials
+
+
+def normalized_difference(lyr1, lyr2):
+    """normalized difference scaled by 1000"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1000 * (lyr1 - lyr2) / (lyr1 + lyr2)
+
+
+class ModisMosaic:
+    """A class to build mosaics of a fixed set of MODIS sinusoidal tiles
+
+    The canvas covers the bounding box of the tiles, as merge_arrays does,
+    or the bounding box of the footprint polygons when given. The buffer is
+    reused: a mosaic is only valid until the next build call at the same
+    resolution.
+
+    Parameters:
+    tiles (list): tile names as hXXvYY
+    dtype (str): canvas data type. Integer canvases use fill_value as nodata
+    footprint (list): polygon files whose bounding box limits the canvas
+    buffer (int): pixels added around the footprint
+    threads (int): threads decoding tiles in build and build_products
+    memory_budget (int): bytes per block. If given, build and build_products return
+    dask-backed mosaics read in row blocks"""
+
+    def __init__(self, tiles=modis_tiles, dtype='float64', footprint=None, buffer=2, threads=1,
+                 memory_budget=None):
+        self.tiles = list(tiles)
+        self.dtype = dtype
+        self.footprint = footprint
+        self.buffer = buffer
+        self.threads = threads
+        self.memory_budget = memory_budget
+        self.bounds = None
+        self.hv = {tile: (int(tile[1:3]), int(tile[4:6])) for tile in self.tiles}
+        self.grids = {}
+        self.buffers = {}
+
+    def __getstate__(self):
+        # output buffers are scratch space, they are not copied to worker processes
+        state = self.__dict__.copy()
+        state['buffers'] = {}
+        return state
+
+    def __repr__(self):
+        return f'Mosaic of {len(self.tiles)} MODIS tiles. Resolutions: {list(self.grids)}'
+
+    def footprint_bounds(self, crs):
+        """return the bounding box of the footprint polygons in the raster crs"""
+        if self.bounds is None:
+            bounds = []
+            for polygons_path in self.footprint:
+                polys = gpd.read_file(polygons_path)
+                if polys.crs is not None and polys.crs != crs:
+                    polys = polys.to_crs(crs)
+                bounds.append(polys.total_bounds)
+            bounds = np.array(bounds)
+            self.bounds = (bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max())
+        return self.bounds
+
+    def grid(self, size, crs=None):
+        """return canvas transform, canvas shape and tile windows for tiles of size x size pixels
+
+        Windows are (tile rows, tile columns, canvas rows, canvas columns) slices,
+        or None for tiles out of the canvas"""
+        if size not in self.grids:
+            hmin = min(h for h, v in self.hv.values())
+            hmax = max(h for h, v in self.hv.values())
+            vmin = min(v for h, v in self.hv.values())
+            vmax = max(v for h, v in self.hv.values())
+            resolution = tile_length / size
+            left = grid_origin[0] + hmin * tile_length
+            top = grid_origin[1] - vmin * tile_length
+            # canvas limits as pixel offsets from the upper left corner of the tiles
+            row0, row1 = 0, (vmax - vmin + 1) * size
+            col0, col1 = 0, (hmax - hmin + 1) * size
+            if self.footprint is not None:
+                xmin, ymin, xmax, ymax = self.footprint_bounds(crs)
+                row0 = max(row0, floor((top - ymax) / resolution) - self.buffer)
+                row1 = min(row1, ceil((top - ymin) / resolution) + self.buffer)
+                col0 = max(col0, floor((xmin - left) / resolution) - self.buffer)
+                col1 = min(col1, ceil((xmax - left) / resolution) + self.buffer)
+                if row1 <= row0 or col1 <= col0:
+                    raise ValueError('The footprint does not intersect the mosaic tiles')
+            transform = Affine(resolution, 0, left + col0 * resolution,
+                               0, -resolution, top - row0 * resolution)
+            shape = (row1 - row0, col1 - col0)
+            windows = {}
+            for tile, (h, v) in self.hv.items():
+                tile_row, tile_col = (v - vmin) * size, (h - hmin) * size
+                r0, r1 = max(row0, tile_row), min(row1, tile_row + size)
+                c0, c1 = max(col0, tile_col), min(col1, tile_col + size)
+                if r1 <= r0 or c1 <= c0:
+                    windows[tile] = None
+                    continue
+                windows[tile] = (slice(r0 - tile_row, r1 - tile_row), slice(c0 - tile_col, c1 - tile_col),
+                                 slice(r0 - row0, r1 - row0), slice(c0 - col0, c1 - col0))
+            self.grids[size] = (transform, shape, windows)
+        return self.grids[size]
+
+    def tile_grid(self, tile, size, crs=None):
+        """return transform, shape, tile rows and tile columns of the window of a tile,
+        or None for tiles out of the canvas"""
+        window = self.grid(size, crs)[2][tile]
+        if window is None:
+            return None
+        tile_rows, tile_cols = window[:2]
+        h, v = self.hv[tile]
+        resolution = tile_length / size
+        transform = Affine(resolution, 0, grid_origin[0] + h * tile_length + tile_cols.start * resolution,
+                           0, -resolution, grid_origin[1] - v * tile_length - tile_rows.start * resolution)
+        shape = (tile_rows.stop - tile_rows.start, tile_cols.stop - tile_cols.start)
+        return transform, shape, tile_rows, tile_cols
+
+    def canvas(self, size, crs=None, product=None):
+        """return the output buffer of a product for tiles of size x size pixels, filled with nodata"""
+        key = (size, product)
+        if key not in self.buffers:
+            transform, shape, windows = self.grid(size, crs)
+            self.buffers[key] = np.empty(shape, dtype=self.dtype)
+        self.buffers[key].fill(fill_value(self.dtype))
+        return self.buffers[key]
+
+    def to_dataarray(self, canvas, size, crs):
+        """wrap a canvas as a georeferenced (band, y, x) DataArray, as merge_arrays returns"""
+        transform, shape, windows = self.grid(size)
+        x = transform.c + transform.a * (np.arange(shape[1]) + 0.5)
+        y = transform.f + transform.e * (np.arange(shape[0]) + 0.5)
+        mosaic = xr.DataArray(canvas[np.newaxis], dims=('band', 'y', 'x'),
+                              coords={'band': [1], 'y': y, 'x': x})
+        mosaic.rio.write_crs(crs, inplace=True)
+        mosaic.rio.write_transform(transform, inplace=True)
+        if not np.issubdtype(np.dtype(self.dtype), np.floating):
+            mosaic.rio.write_nodata(fill_value(self.dtype), inplace=True)
+        return mosaic
+
+    def build(self, raster_list, layers, function=None):
+        """mosaic a layer, or a function of several layers, of the scene tiles
+
+        Only the window of each tile inside the canvas is read.
+
+        Parameters:
+        raster_list (list): MODIS files of the scene
+        layers (list): layers read from each file
+        function: combines the layers of each tile. Default takes the first layer"""
+        return self.build_products(raster_list, {None: (layers, function)})[None]
+
+    def build_products(self, raster_list, products):
+        """mosaic several products of the scene tiles, opening each tile once
+
+        Layers used by several products are read once. Tiles are decoded on
+        self.threads threads. With a memory budget, build_lazy is used.
+
+        Parameters:
+        raster_list (list): MODIS files of the scene
+        products (dict): product name -> (layers, function), as in build
+
+        Returns:
+        dict: product name -> mosaic"""
+        if self.memory_budget is not None:
+            return self.build_lazy(raster_list, products)
+        layers = list(dict.fromkeys(layer for product_layers, function in products.values()
+                                    for layer in product_layers))
+        with open_layer(raster_list[0], layers[0]) as src:
+            size = src.shape[-1]
+            crs = src.rio.crs
+        windows = []
+        for raster in raster_list:
+            tile = tile_name(raster)
+            if tile not in self.hv:
+                raise ValueError(f'Tile {tile} is not part of the mosaic')
+            window = self.grid(size, crs)[2][tile]
+            if window is not None:
+                windows.append((raster, window))
+        canvases = {product: self.canvas(size, crs, product) for product in products}
+
+        def decode(raster, window):
+            # every call opens its own dataset handles, and tiles write into disjoint canvas slices
+            tile_rows, tile_cols, rows, cols = window
+            values = read_window(raster, layers, tile_rows, tile_cols)
+            for product, (product_layers, function) in products.items():
+                product_values = [values[layer] for layer in product_layers]
+                canvases[product][rows, cols] = encode(product_values[0] if function is None
+                                                       else function(*product_values), self.dtype)
+
+        if self.threads > 1 and len(windows) > 1:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                list(executor.map(decode, *zip(*windows)))
+        else:
+            for raster, window in windows:
+                decode(raster, window)
+        return {product: self.to_dataarray(canvas, size, crs) for product, canvas in canvases.items()}
+
+    def build_lazy(self, raster_list, products):
+        """mosaic several products of the scene tiles as dask-backed arrays
+
+        The canvas is split in blocks of rows sized so that the layers, about
+        four intermediates of the functions and the outputs of a block fit in
+        self.memory_budget bytes. Every product of a block comes from the same
+        task, which reads and decodes each tile once, so blocks of several
+        products computed together (as hidrocl_zonal does) are read once.
+        Nothing is read until a block is computed.
+
+        Parameters:
+        raster_list (list): MODIS files of the scene
+        products (dict): product name -> (layers, function), as in build
+
+        Returns:
+        dict: product name -> dask-backed mosaic"""
+        first_layer = next(iter(products.values()))[0][0]
+        with open_layer(raster_list[0], first_layer) as src:
+            size = src.shape[-1]
+            crs = src.rio.crs
+        transform, shape, windows = self.grid(size, crs)
+        tiles = []
+        for raster in raster_list:
+            tile = tile_name(raster)
+            if tile not in self.hv:
+                raise ValueError(f'Tile {tile} is not part of the mosaic')
+            if windows[tile] is not None:
+                tiles.append((raster, windows[tile]))
+        layers = set(layer for product_layers, function in products.values() for layer in product_layers)
+        # layers and intermediates are float, the blocks have the canvas type
+        row_bytes = shape[1] * (8 * (len(layers) + 4) + len(products) * np.dtype(self.dtype).itemsize)
+        block_rows = int(max(1, min(shape[0], self.memory_budget // row_bytes)))
+        blocks = {product: [] for product in products}
+        for row0 in range(0, shape[0], block_rows):
+            row1 = min(row0 + block_rows, shape[0])
+            product_blocks = dask.delayed(read_blocks)(tiles, products, row0, row1, shape[1], self.dtype)
+            for product in products:
+                blocks[product].append(da.from_delayed(product_blocks[product], shape=(row1 - row0, shape[1]),
+                                                       dtype=self.dtype))
+        return {product: self.to_dataarray(da.concatenate(blocks[product]), size, crs) for product in products}
+
+    def partials(self, raster_list, products, polygons_paths, sketch=False, workers=1):
+        """reduce the products of the scene tiles to zonal partials, without a mosaic
+
+        Each tile is read and reduced on its own and the partials of all tiles
+        are merged, so only one tile is held in memory per worker. Functions
+        must be module level functions when workers > 1.
+
+        Parameters:
+        raster_list (list): MODIS files of the scene
+        products (dict): product name -> (layers, function), as in build
+        polygons_paths (list): polygon files
+        sketch (bool): keep quantile sketches
+        workers (int): processes reducing tiles in parallel
+
+        Returns:
+        dict: product name -> list of merged hidrocl_zonal.ZonalPartials, one per polygon file"""
+        first_layer = next(iter(products.values()))[0][0]
+        with open_layer(raster_list[0], first_layer) as src:
+            size = src.shape[-1]
+            crs = src.rio.crs
+        tasks = []
+        for raster in raster_list:
+            tile = tile_name(raster)
+            if tile not in self.hv:
+                raise ValueError(f'Tile {tile} is not part of the mosaic')
+            tile_grid = self.tile_grid(tile, size, crs)
+            if tile_grid is not None:
+                tasks.append((raster, products, polygons_paths, tile_grid, crs, sketch))
+        if len(tasks) == 0:
+            raise ValueError('No tile of the scene is inside the canvas')
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(tile_partials, *zip(*tasks)))
+        else:
+            results = [tile_partials(*task) for task in tasks]
+        return {product: [reduce(operator.add, [result[product][i] for result in results])
+                          for i in range(len(polygons_paths))]
+                for product in products}
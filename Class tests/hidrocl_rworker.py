@@ -0,0 +1,138 @@
+"""
+long-lived R sessions for the weighted extraction scripts
+what does it do?
+ - starts a few Rscript sessions running RWorker.R, which load terra, sf
+   and exactextractr once and keep the polygons read
+ - sends extraction jobs to an idle session through its stdin and waits
+   for the answer, so R startup and polygon reading are paid once
+ - run_Weighted*Extraction in hidroclabc use it when started, and call
+   Rscript as before otherwise
+"""
+
+import queue
+import atexit
+import threading
+import subprocess
+
+pool = None
+
+
+class RWorkerPool:
+    """A class to hold a pool of R sessions running RWorker.R
+
+    Parameters:
+    rscript_path (str): path to Rscript
+    worker_script (str): path to RWorker.R
+    workers (int): number of R sessions"""
+
+    def __init__(self, rscript_path, worker_script, workers=2):
+        self.rscript_path = rscript_path
+        self.worker_script = worker_script
+        self.processes = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.live = workers
+        for _ in range(workers):
+            self.idle.put(self.start_worker())
+
+    def __repr__(self):
+        return f'R worker pool with {len(self.processes)} sessions'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start_worker(self):
+        """start an R session and wait until its packages are loaded"""
+        process = subprocess.Popen([self.rscript_path, '--vanilla', self.worker_script],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   text=True,
+                                   bufsize=1)
+        self.processes.append(process)
+        self.read_status(process, ('ready',))
+        return process
+
+    def read_status(self, process, statuses):
+        """read R session output until a status line, skipping anything else R prints"""
+        while True:
+            line = process.stdout.readline()
+            if line == '':
+                self.processes.remove(process)
+                raise RuntimeError(f'R worker stopped with code {process.wait()}')
+            if line.startswith(statuses):
+                return line.rstrip('\n')
+
+    def discard(self, process):
+        """kill a failed R session and forget it"""
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        if process in self.processes:
+            self.processes.remove(process)
+
+    def run(self, function, polygons, raster, result_file):
+        """run an extraction job on the first idle R session and wait for it
+
+        Parameters:
+        function (str): mean, quantile or percent
+        polygons (str): polygon file
+        raster (str): raster file
+        result_file (str): output file
+
+        Raises:
+        RuntimeError: with the message of R when the job fails, or when no R session is left"""
+        process = self.idle.get()
+        if process is None:
+            # wake up the next waiting job too
+            self.idle.put(None)
+            raise RuntimeError('No R workers left')
+        try:
+            process.stdin.write('\t'.join([function, polygons, raster, result_file]) + '\n')
+            process.stdin.flush()
+            status = self.read_status(process, ('done', 'error'))
+        except (RuntimeError, OSError):
+            # the session died, a new one takes its place
+            self.discard(process)
+            try:
+                self.idle.put(self.start_worker())
+            except (RuntimeError, OSError) as start_error:
+                print(f'R worker could not be restarted: {start_error}')
+                with self.lock:
+                    self.live -= 1
+                    if self.live == 0:
+                        self.idle.put(None)
+            raise
+        self.idle.put(process)
+        if status.startswith('error'):
+            raise RuntimeError(f'R worker error for {raster}: {status.split(chr(9), 1)[-1]}')
+
+    def close(self):
+        """stop every R session"""
+        for process in self.processes:
+            if process.poll() is None:
+                process.stdin.close()
+                process.wait()
+        self.processes = []
+
+
+def start(rscript_path, worker_script, workers=2):
+    """start the module pool, used by run_Weighted*Extraction in hidroclabc"""
+    global pool
+    if pool is None:
+        pool = RWorkerPool(rscript_path, worker_script, workers)
+        print(f'Started {workers} R workers')
+    return pool
+
+
+def stop():
+    """stop the module pool"""
+    global pool
+    if pool is not None:
+        pool.close()
+        pool = None
+
+
+atexit.register(stop)
@@ -0,0 +1,749 @@
+"""
+storage backends of the hidrocl variable databases
+what does it do?
+ - opens a database by the suffix of its path: .csv files keep the wide
+   layout (name_id, date, one column per gauge id), .parquet folders keep
+   the same table with typed columns, in one folder per year, and .matrix
+   folders keep the values as a fixed width binary matrix with an NA
+   sentinel, opened with numpy.memmap to slice dates and catchments without
+   parsing anything
+ - appends rows to any of them. Parquet appends write a new part in the
+   folder of each year, and compact merges the parts of a year once it holds
+   too many of them (or of every year after a conversion). Matrix
+   appends add one row per scene at the end of the matrix
+ - reads the whole table (or some years of a parquet store) as the
+   observations of HidroCLVariable, and reads only the id column to know
+   what is already in the database
+ - keeps a sidecar index of CSV databases (<database>.idx) with the id,
+   byte offset and size of each row. Appends update it, and rows written by
+   other tools are indexed from the last indexed byte, so membership checks
+   never read the whole CSV
+ - converts existing CSV databases to parquet or matrix stores
+ - buffers the rows and log lines of many scenes in a DatabaseWriter, and
+   writes each database once per batch with one write and one fsync
+"""
+
+import io
+import os
+import json
+import time
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def open_store(path):
+    """open the storage backend of a database path: ParquetStore for .parquet,
+    MatrixStore for .matrix, CSVStore otherwise"""
+    if path.rstrip('/').endswith('.parquet'):
+        return ParquetStore(path)
+    if path.rstrip('/').endswith('.matrix'):
+        return MatrixStore(path)
+    return CSVStore(path)
+
+
+def numeric_values(values):
+    """values of a row as float, with nan for NA or any other text"""
+    try:
+        return np.asarray(values, dtype='float64')
+    except ValueError:
+        return pd.to_numeric(pd.Series(list(values), dtype=object), errors='coerce').to_numpy(dtype='float64')
+
+
+def format_values(values, dtype='int32'):
+    """database text of numeric values, with NA for missing values
+
+    Integer types round values up, and write NA for nan and for values out of
+    the range of the type, whose lowest (signed) or highest (unsigned) value
+    is nodata. Float types keep the values
+
+    Parameters:
+    values (array): values, with nan for missing values
+    dtype (str): value type of the variable
+
+    Returns:
+    list: values as strings"""
+    values = np.asarray(values, dtype='float64')
+    dtype = np.dtype(dtype)
+    text = np.full(values.shape, 'NA', dtype=object)
+    if np.issubdtype(dtype, np.integer):
+        values, valid = integer_values(values, dtype)
+        text[valid] = values[valid].astype('int64').astype(str)
+    else:
+        valid = np.isfinite(values)
+        text[valid] = values[valid].astype(str)
+    return text.tolist()
+
+
+def na_value(dtype):
+    """NA sentinel of a value type: nan for floats, the lowest value of signed and the highest of unsigned integers"""
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        return np.nan
+    if np.issubdtype(dtype, np.signedinteger):
+        return np.iinfo(dtype).min
+    return np.iinfo(dtype).max
+
+
+def integer_values(values, dtype):
+    """values rounded up, and a mask of the values in the range of an integer type, without its NA sentinel"""
+    values = np.ceil(values)
+    info = np.iinfo(dtype)
+    if np.issubdtype(dtype, np.signedinteger):
+        low, high = info.min + 1, info.max
+    else:
+        low, high = info.min, info.max - 1
+    with np.errstate(invalid='ignore'):
+        valid = (values >= low) & (values <= high)
+    return values, valid
+
+
+class IdIndex:
+    """A class to hold the sidecar index of a CSV database
+
+    Each line of the index is id,offset,size of a row of the database. The
+    first line is the header line of the database, as header,0,size.
+
+    Parameters:
+    database (str): CSV database"""
+
+    def __init__(self, database):
+        self.database = database
+        self.path = database + '.idx'
+
+    def __repr__(self):
+        return f'Index of {self.database}'
+
+    def read(self):
+        """entries of the index as a list of (id, offset, size)"""
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path) as the_file:
+            for line in the_file:
+                if line.endswith('\n'):  # skip a line cut by a crash
+                    file_id, offset, size = line.rstrip('\n').rsplit(',', 2)
+                    entries.append((file_id, int(offset), int(size)))
+        return entries
+
+    def valid(self, entries):
+        """check that the last indexed row is still in the database"""
+        if len(entries) == 0:
+            return False
+        file_id, offset, size = entries[-1]
+        if os.path.getsize(self.database) < offset + size:
+            return False
+        with open(self.database, 'rb') as the_file:
+            the_file.seek(offset)
+            row = the_file.read(size)
+        if len(entries) == 1:
+            return row.endswith(b'\n')
+        return row.endswith(b'\n') and row.startswith(file_id.encode() + b',')
+
+    @staticmethod
+    def scan(data, offset, first=False):
+        """entries of the complete lines of data, starting at offset"""
+        entries = []
+        start = 0
+        end = data.find(b'\n')
+        while end >= 0:
+            line = data[start:end + 1]
+            if first and len(entries) == 0:
+                entries.append(('header', offset, len(line)))
+            elif len(line) > 1:
+                entries.append((line.split(b',', 1)[0].decode(), offset + start, len(line)))
+            start = end + 1
+            end = data.find(b'\n', start)
+        return entries
+
+    def write(self, entries, mode='a'):
+        """write entries to the index"""
+        if len(entries) == 0 and mode == 'a':
+            return
+        lines = ''.join(f'{file_id},{offset},{size}\n' for file_id, offset, size in entries)
+        if mode == 'w':
+            temporal_file = f'{self.path}.{os.getpid()}.tmp'
+            with open(temporal_file, 'w') as the_file:
+                the_file.write(lines)
+            os.replace(temporal_file, self.path)
+        else:
+            with open(self.path, 'a') as the_file:
+                the_file.write(lines)
+
+    def update(self):
+        """index the rows appended to the database after the last indexed row,
+        or every row if the index is missing or does not match the database
+
+        Returns:
+        list: entries of the index"""
+        if not os.path.exists(self.database):
+            return []
+        entries = self.read()
+        if self.valid(entries):
+            _, offset, size = entries[-1]
+            with open(self.database, 'rb') as the_file:
+                the_file.seek(offset + size)
+                new_entries = self.scan(the_file.read(), offset + size)
+            self.write(new_entries)
+            return entries + new_entries
+        with open(self.database, 'rb') as the_file:
+            entries = self.scan(the_file.read(), 0, first=True)
+        self.write(entries, mode='w')
+        return entries
+
+    def ids(self):
+        """set of ids in the database"""
+        return {file_id for file_id, _, _ in self.update()[1:]}
+
+    def offsets(self):
+        """dict of id -> (offset, size) of its row in the database"""
+        return {file_id: (offset, size) for file_id, offset, size in self.update()[1:]}
+
+
+class CSVStore:
+    """A class to hold a database in a wide CSV file (name_id, date, gauge ids...)
+
+    Parameters:
+    path (str): CSV file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = IdIndex(path)
+
+    def __repr__(self):
+        return f'CSV database {self.path}'
+
+    def exists(self):
+        """check if the database exists"""
+        return os.path.exists(self.path)
+
+    def create(self, catchment_names, id_name='name_id', dtype=None):
+        """create the database with its header line"""
+        header_line = [str(s) for s in catchment_names]
+        header_line.insert(0, id_name)
+        header_line.insert(1, 'date')
+        header_line = ','.join(header_line) + '\n'
+        with open(self.path, 'w') as the_file:
+            the_file.write(header_line)
+        self.index.write([('header', 0, len(header_line.encode()))], mode='w')
+
+    def columns(self):
+        """columns of the header line"""
+        with open(self.path) as the_file:
+            return the_file.readline().rstrip('\n').split(',')
+
+    def read(self):
+        """read the database as a table indexed by date"""
+        observations = pd.read_csv(self.path)
+        observations.date = pd.to_datetime(observations.date, format='%Y-%m-%d')
+        observations.set_index(['date'], inplace=True)
+        return observations
+
+    def read_new(self, state=None):
+        """read the rows appended after a previous read
+
+        The state of a read is the header line, the byte offset and row count
+        read, and the last row read. If the header or the last row read are not
+        where they were, the database was replaced or rewritten and every row
+        is read again. A database replaced with a copy of its rows plus new
+        ones is still read from the offset
+
+        Parameters:
+        state (tuple): state of a previous read. None to read every row
+
+        Returns:
+        tuple: observations, state of this read and True if observations
+        only hold the new rows, or False if they hold every row"""
+        with open(self.path, 'rb') as the_file:
+            header = the_file.readline()
+            if state is not None:
+                old_header, offset, nrows, last_row = state
+                the_file.seek(offset - len(last_row))
+                if header != old_header or the_file.read(len(last_row)) != last_row:
+                    print(f'Database {self.path} changed, reading every row')
+                    return self.read_new()
+            else:
+                offset, nrows, last_row = len(header), 0, b''
+            data = the_file.read()
+        data = data[:data.rfind(b'\n') + 1]  # skip a row that is still being written
+        if len(data) > 0:
+            last_row = data[data.rfind(b'\n', 0, len(data) - 1) + 1:]
+        observations = pd.read_csv(io.BytesIO(header + data))
+        observations.date = pd.to_datetime(observations.date, format='%Y-%m-%d')
+        observations.set_index(['date'], inplace=True)
+        return observations, (header, offset + len(data), nrows + len(observations), last_row), state is not None
+
+    def ids(self):
+        """set of ids in the database, from its sidecar index"""
+        return self.index.ids()
+
+    def append(self, rows, atomic=False):
+        """append rows as (id, date, values), values as strings with NA for missing values,
+        and add them to the sidecar index
+
+        Parameters:
+        rows (list): rows to append
+        atomic (bool): cut a half-written row left by a failed append (anything
+        after the last complete row of the index), write the rows with one
+        write and fsync them. Readers and the index skip a row cut by a crash,
+        and the next append removes it"""
+        if len(rows) == 0:
+            return
+        lines = [(','.join([file_id, file_date] + list(values)) + '\n').encode() for file_id, file_date, values in rows]
+        entries = self.index.update()
+        indexed = len(entries) > 0
+        if atomic and indexed:
+            _, offset, size = entries[-1]
+            with open(self.path, 'r+b') as the_file:
+                the_file.truncate(offset + size)
+                the_file.seek(offset + size)
+                offset = the_file.tell()
+                the_file.write(b''.join(lines))
+                the_file.flush()
+                os.fsync(the_file.fileno())
+        else:
+            with open(self.path, 'ab') as the_file:
+                offset = the_file.tell()
+                the_file.write(b''.join(lines))
+        if not indexed:  # new file, index it from its first line
+            self.index.update()
+            return
+        entries = []
+        for (file_id, _, _), line in zip(rows, lines):
+            entries.append((file_id, offset, len(line)))
+            offset += len(line)
+        self.index.write(entries)
+
+
+class ParquetStore:
+    """A class to hold a database as a folder of parquet parts partitioned by year
+
+    The folder keeps header.json (id column, catchment names and value type)
+    and one folder per year with the parts appended to it. Values are typed
+    columns named as the gauge ids, with nan for missing values.
+
+    Parameters:
+    path (str): .parquet folder
+    max_parts (int): parts a year may hold before append merges them"""
+
+    def __init__(self, path, max_parts=20):
+        self.path = path
+        self.max_parts = max_parts
+        self.header_path = os.path.join(path, 'header.json')
+
+    def __repr__(self):
+        return f'Parquet database {self.path}'
+
+    def exists(self):
+        """check if the database exists"""
+        return os.path.exists(self.header_path)
+
+    def header(self):
+        """id column name, catchment names and value type"""
+        with open(self.header_path) as the_file:
+            return json.load(the_file)
+
+    def create(self, catchment_names, id_name='name_id', dtype='float64'):
+        """create the database folder and its header"""
+        os.makedirs(self.path, exist_ok=True)
+        header = {'id_name': id_name, 'catchment_names': [str(s) for s in catchment_names], 'dtype': dtype}
+        temporal_file = f'{self.header_path}.{os.getpid()}.tmp'
+        with open(temporal_file, 'w') as the_file:
+            json.dump(header, the_file)
+        os.replace(temporal_file, self.header_path)
+
+    def columns(self):
+        """columns of the table, as the header line of a CSV database"""
+        header = self.header()
+        return [header['id_name'], 'date'] + header['catchment_names']
+
+    def years(self):
+        """years with parts in the database"""
+        return sorted(value for value in os.listdir(self.path) if value.isdigit())
+
+    def parts(self, years=None):
+        """part files of some years, or of every year"""
+        years = self.years() if years is None else [str(year) for year in years]
+        parts = []
+        for year in years:
+            folder = os.path.join(self.path, year)
+            if os.path.isdir(folder):
+                parts += sorted(os.path.join(folder, value) for value in os.listdir(folder)
+                                if value.endswith('.parquet'))
+        return parts
+
+    def schema(self, header=None):
+        """arrow schema of the parts"""
+        header = self.header() if header is None else header
+        value_type = pa.from_numpy_dtype(np.dtype(header['dtype']))
+        return pa.schema([(header['id_name'], pa.string()), ('date', pa.timestamp('ns'))]
+                         + [(name, value_type) for name in header['catchment_names']])
+
+    def read_table(self, years=None, columns=None):
+        """read parts of some years (or every year) as an arrow table"""
+        schema = self.schema()
+        parts = self.parts(years)
+        if columns is not None:
+            schema = pa.schema([schema.field(name) for name in columns])
+        if len(parts) == 0:
+            return schema.empty_table()
+        return pa.concat_tables([pq.read_table(part, columns=columns, schema=schema) for part in parts])
+
+    def read(self, years=None):
+        """read the database as a table indexed by date
+
+        Parameters:
+        years (list): years to read. Default is every year"""
+        observations = self.read_table(years).to_pandas()
+        observations.set_index(['date'], inplace=True)
+        return observations
+
+    def read_new(self, state=None):
+        """read every row, as parts may be added to any year
+
+        Returns:
+        tuple: observations, None as state and False, since observations hold every row"""
+        return self.read(), None, False
+
+    def ids(self):
+        """set of ids in the database, reading only the id column"""
+        id_name = self.header()['id_name']
+        return set(self.read_table(columns=[id_name]).column(id_name).to_pylist())
+
+    def write_part(self, table, year):
+        """write a part of a year through a temporary file"""
+        folder = os.path.join(self.path, str(year))
+        os.makedirs(folder, exist_ok=True)
+        name = f'part-{time.time_ns()}-{os.getpid()}.parquet'
+        temporal_file = os.path.join(folder, f'.{name}.tmp')
+        pq.write_table(table, temporal_file)
+        os.replace(temporal_file, os.path.join(folder, name))
+
+    def append(self, rows, atomic=True):
+        """append rows as (id, date, values), values as strings with NA for missing values,
+        or as numbers with nan. Rows are written as one part per year, and parts are
+        always written through a temporary file. Years with more than max_parts parts
+        are compacted"""
+        if len(rows) == 0:
+            return
+        header = self.header()
+        schema = self.schema(header)
+        dates = pd.to_datetime([file_date for _, file_date, _ in rows], format='%Y-%m-%d')
+        values = np.array([numeric_values(row_values) for _, _, row_values in rows], dtype='float64')
+        if values.shape[1] != len(header['catchment_names']):
+            raise ValueError(f'Rows of {values.shape[1]} values for {len(header["catchment_names"])} catchments')
+        for year in sorted(set(dates.year)):
+            keep = np.flatnonzero(dates.year == year)
+            arrays = [pa.array([rows[i][0] for i in keep], pa.string()),
+                      pa.array(dates[keep].values, pa.timestamp('ns'))]
+            arrays += [pa.array(values[keep, j], schema.field(j + 2).type, from_pandas=True)
+                       for j in range(values.shape[1])]
+            self.write_part(pa.Table.from_arrays(arrays, schema=schema), year)
+            if len(self.parts([year])) > self.max_parts:
+                self.compact([year])
+
+    def compact(self, years=None):
+        """merge the parts of each year into one part
+
+        Parameters:
+        years (list): years to compact. Default is every year"""
+        for year in self.years() if years is None else [str(year) for year in years]:
+            # a lock file keeps two processes from merging the same parts twice
+            lock_file = os.path.join(self.path, year, '.compact.lock')
+            try:
+                os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL))
+            except FileExistsError:
+                print(f'Year {year} of {self.path} is being compacted by another process')
+                continue
+            try:
+                parts = self.parts([year])
+                if len(parts) > 1:
+                    self.write_part(self.read_table([year]), year)
+                    for part in parts:
+                        os.remove(part)
+            finally:
+                os.remove(lock_file)
+
+
+class MatrixStore:
+    """A class to hold a database as a fixed width binary matrix
+
+    The folder keeps meta.json (id column, catchment names, value type and NA
+    sentinel), rows.csv with the id and date of each row, and data.bin with
+    one row of values per scene, in the order of the catchment names. Rows
+    beyond the last line of rows.csv are left over by a failed append and are
+    overwritten by the next one.
+
+    Parameters:
+    path (str): .matrix folder"""
+
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.rows_path = os.path.join(path, 'rows.csv')
+        self.data_path = os.path.join(path, 'data.bin')
+        self.meta_cache = (None, None)
+        self.rows_cache = (None, None, None)
+        self.matrix_cache = (None, None)
+
+    def __repr__(self):
+        return f'Matrix database {self.path}'
+
+    def exists(self):
+        """check if the database exists"""
+        return os.path.exists(self.meta_path)
+
+    def meta(self):
+        """id column name, catchment names, value type and NA sentinel"""
+        stat = os.stat(self.meta_path)
+        key = (stat.st_ino, stat.st_mtime_ns)
+        if self.meta_cache[0] != key:
+            with open(self.meta_path) as the_file:
+                self.meta_cache = (key, json.load(the_file))
+        return self.meta_cache[1]
+
+    def create(self, catchment_names, id_name='name_id', dtype='int32'):
+        """create the database folder with its meta and empty rows and data"""
+        os.makedirs(self.path, exist_ok=True)
+        na = na_value(dtype)
+        meta = {'id_name': id_name, 'catchment_names': [str(s) for s in catchment_names], 'dtype': dtype,
+                'na': None if np.isnan(na) else int(na)}
+        temporal_file = f'{self.meta_path}.{os.getpid()}.tmp'
+        with open(temporal_file, 'w') as the_file:
+            json.dump(meta, the_file)
+        open(self.rows_path, 'w').close()
+        open(self.data_path, 'wb').close()
+        os.replace(temporal_file, self.meta_path)
+
+    def columns(self):
+        """columns of the table, as the header line of a CSV database"""
+        meta = self.meta()
+        return [meta['id_name'], 'date'] + meta['catchment_names']
+
+    def rows(self):
+        """ids and dates of the rows, read again only when rows.csv changed"""
+        stat = os.stat(self.rows_path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if self.rows_cache[0] != key:
+            if stat.st_size == 0:
+                rows = pd.DataFrame({'id': [], 'date': []}, dtype=str)
+            else:
+                rows = pd.read_csv(self.rows_path, header=None, names=['id', 'date'], dtype=str)
+            self.rows_cache = (key, rows, pd.to_datetime(rows['date'], format='%Y-%m-%d').to_numpy())
+        return self.rows_cache[1]
+
+    def ids(self):
+        """set of ids in the database, from its rows"""
+        return set(self.rows()['id'])
+
+    def dates(self):
+        """dates of the rows"""
+        self.rows()
+        return self.rows_cache[2]
+
+    def matrix(self, nrows=None):
+        """values as a read only numpy.memmap of rows x catchments, with the NA sentinel for missing values"""
+        meta = self.meta()
+        nrows = len(self.rows()) if nrows is None else nrows
+        shape = (nrows, len(meta['catchment_names']))
+        if nrows == 0:
+            return np.empty(shape, dtype=meta['dtype'])
+        if self.matrix_cache[0] != shape:
+            self.matrix_cache = (shape, np.memmap(self.data_path, dtype=meta['dtype'], mode='r', shape=shape))
+        return self.matrix_cache[1]
+
+    def select(self, start=None, end=None, catchments=None):
+        """slice the matrix by a date range and some catchments
+
+        Rows are in the order scenes were written, which is not always date
+        order, so rows are selected by comparing their dates. Contiguous rows
+        and a single catchment or every catchment are views of the memmap,
+        other selections are copies of the selected values only
+
+        Parameters:
+        start (str): first date, included
+        end (str): last date, included
+        catchments (list): catchment names. Default is every catchment
+
+        Returns:
+        tuple: dates of the rows, catchment names and values"""
+        meta = self.meta()
+        dates = self.dates()
+        matrix = self.matrix(len(dates))
+        keep = np.ones(len(dates), dtype=bool)
+        if start is not None:
+            keep &= dates >= np.datetime64(start)
+        if end is not None:
+            keep &= dates <= np.datetime64(end)
+        rows = np.flatnonzero(keep)
+        if len(rows) == 0 or rows[-1] - rows[0] + 1 == len(rows):
+            rows = slice(rows[0], rows[-1] + 1) if len(rows) > 0 else slice(0, 0)
+        names = meta['catchment_names']
+        if catchments is None:
+            return dates[rows], names, matrix[rows]
+        columns = [names.index(str(name)) for name in catchments]
+        if len(columns) == 1:
+            return dates[rows], [names[columns[0]]], matrix[rows, columns[0]:columns[0] + 1]
+        if isinstance(rows, slice):
+            return dates[rows], [names[i] for i in columns], matrix[rows][:, columns]
+        return dates[rows], [names[i] for i in columns], matrix[np.ix_(rows, columns)]
+
+    def read(self, first=0):
+        """read the database as a table indexed by date, with nan for missing values
+
+        Parameters:
+        first (int): first row to read"""
+        meta = self.meta()
+        rows = self.rows().iloc[first:]
+        values = np.asarray(self.matrix(first + len(rows))[first:], dtype='float64')
+        if meta['na'] is not None:
+            values[values == meta['na']] = np.nan
+        observations = pd.DataFrame(values, columns=meta['catchment_names'])
+        observations.insert(0, meta['id_name'], rows['id'].to_numpy())
+        observations.index = pd.DatetimeIndex(pd.to_datetime(rows['date'], format='%Y-%m-%d'), name='date')
+        return observations
+
+    def read_new(self, state=None):
+        """read the rows appended after a previous read
+
+        The state of a read is the meta and the ids of the rows read. If they
+        changed, every row is read again
+
+        Parameters:
+        state (tuple): state of a previous read. None to read every row
+
+        Returns:
+        tuple: observations, state of this read and True if observations
+        only hold the new rows, or False if they hold every row"""
+        meta = self.meta()
+        ids = self.rows()['id'].tolist()
+        if state is not None:
+            old_meta, old_ids = state
+            if old_meta != meta or ids[:len(old_ids)] != old_ids:
+                print(f'Database {self.path} changed, reading every row')
+                state = None
+        first = 0 if state is None else len(state[1])
+        return self.read(first), (meta, ids), state is not None
+
+    def append(self, rows, atomic=False):
+        """append rows as (id, date, values), values as strings with NA for missing values,
+        or as numbers with nan. Integer values are rounded up
+
+        Values are written before the rows, so a failed append never adds a
+        row without its values
+
+        Parameters:
+        rows (list): rows to append
+        atomic (bool): fsync the data before adding the rows"""
+        if len(rows) == 0:
+            return
+        meta = self.meta()
+        dtype = np.dtype(meta['dtype'])
+        values = np.array([numeric_values(row_values) for _, _, row_values in rows], dtype='float64')
+        if values.shape[1] != len(meta['catchment_names']):
+            raise ValueError(f'Rows of {values.shape[1]} values for {len(meta["catchment_names"])} catchments')
+        if np.issubdtype(dtype, np.integer):
+            values, valid = integer_values(values, dtype)
+            values[~valid] = meta['na']
+        data = np.ascontiguousarray(values.astype(dtype))
+        nrows = len(self.rows())
+        with open(self.data_path, 'r+b') as the_file:
+            the_file.truncate(nrows * dtype.itemsize * values.shape[1])
+            the_file.seek(0, os.SEEK_END)
+            the_file.write(data.tobytes())
+            if atomic:
+                the_file.flush()
+                os.fsync(the_file.fileno())
+        lines = ''.join(f'{file_id},{file_date}\n' for file_id, file_date, _ in rows)
+        with open(self.rows_path, 'a') as the_file:
+            the_file.write(lines)
+            if atomic:
+                the_file.flush()
+                os.fsync(the_file.fileno())
+
+
+class DatabaseWriter:
+    """A class to buffer database rows and log lines, and write them in batches
+
+    Rows of each database are written at once with an atomic append (one
+    write and one fsync after the last complete row), and the lines of each
+    log file with one write.
+    Use it as a context manager to write what is left when it is closed
+
+    Parameters:
+    batch_size (int): scenes buffered before writing. Default is 50"""
+
+    def __init__(self, batch_size=50):
+        self.batch_size = batch_size
+        self.rows = defaultdict(list)
+        self.logs = defaultdict(list)
+        self.scenes = 0
+
+    def __repr__(self):
+        return f'Database writer with {sum(len(rows) for rows in self.rows.values())} rows to write'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add(self, database, file_id, file_date, values):
+        """buffer a row of a database"""
+        self.rows[database].append((file_id, file_date, values))
+
+    def log(self, log_file, line):
+        """buffer a line of a log file"""
+        self.logs[log_file].append(line)
+
+    def end_scene(self):
+        """count a buffered scene, writing the batch when it is full"""
+        self.scenes += 1
+        if self.scenes >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """write the buffered rows and log lines"""
+        for database, rows in self.rows.items():
+            open_store(database).append(rows, atomic=True)
+        for log_file, lines in self.logs.items():
+            with open(log_file, 'a') as txt_file:
+                txt_file.write(''.join(lines))
+                txt_file.flush()
+                os.fsync(txt_file.fileno())
+        if len(self.rows) > 0:
+            print(f'Wrote {sum(len(rows) for rows in self.rows.values())} rows to {len(self.rows)} databases')
+        self.rows.clear()
+        self.logs.clear()
+        self.scenes = 0
+
+
+def convert_csv(csv_path, store_path, dtype='float64', chunksize=1000):
+    """convert a CSV database to a parquet or matrix store
+
+    Parameters:
+    csv_path (str): CSV database
+    store_path (str): .parquet or .matrix folder
+    dtype (str): value type of the store
+    chunksize (int): rows read at once
+
+    Returns:
+    ParquetStore or MatrixStore: the new store"""
+    columns = CSVStore(csv_path).columns()
+    store = open_store(store_path)
+    if isinstance(store, CSVStore):
+        raise ValueError(f'Database {store_path} is not a .parquet or .matrix folder')
+    if store.exists():
+        raise ValueError(f'Database {store_path} already exists')
+    store.create(columns[2:], columns[0], dtype)
+    rows = 0
+    for chunk in pd.read_csv(csv_path, dtype={columns[0]: str, 'date': str}, chunksize=chunksize):
+        values = chunk.iloc[:, 2:].to_numpy(dtype='float64')
+        store.append(list(zip(chunk.iloc[:, 0], chunk.iloc[:, 1], values)))
+        rows += len(chunk)
+    if isinstance(store, ParquetStore):
+        store.compact()
+    print(f'Converted {rows} rows of {csv_path} to {store_path}')
+    return store
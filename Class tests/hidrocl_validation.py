@@ -0,0 +1,131 @@
+"""
+integrity validation of downloaded product files
+what does it do?
+ - checks the signature of each file first (HDF4, HDF5/netCDF4, netCDF
+   classic, TIFF), so empty, truncated headers and files of the wrong type
+   are rejected without opening them
+ - opens the files that pass with rasterio, which only reads metadata
+ - checks files on a pool of processes
+ - records the result with the (size, mtime) fingerprint of each file in the
+   hidrocl_catalog file catalog, so unchanged files are never checked again
+ - moves corrupt files to the quarantine folder of the product instead of
+   deleting them
+"""
+
+import os
+import time
+import rasterio
+from concurrent.futures import ProcessPoolExecutor
+
+import hidrocl_catalog as catalog
+
+signatures = {
+    'hdf4': [(0, b'\x0e\x03\x13\x01')],
+    # the HDF5 superblock can be at 0, 512, 1024, 2048... bytes
+    'hdf5': [(offset, b'\x89HDF\r\n\x1a\n') for offset in (0, 512, 1024, 2048, 4096)],
+    'netcdf': [(0, b'CDF\x01'), (0, b'CDF\x02'), (0, b'CDF\x05')],
+    'tiff': [(0, b'II*\x00'), (0, b'MM\x00*'), (0, b'II+\x00'), (0, b'MM\x00+')],
+}
+
+extension_formats = {
+    '.hdf': ('hdf4',),
+    '.hdf5': ('hdf5',),
+    '.h5': ('hdf5',),
+    '.nc4': ('hdf5', 'netcdf'),
+    '.nc': ('hdf5', 'netcdf'),
+    '.tif': ('tiff',),
+    '.tiff': ('tiff',),
+}
+
+
+def file_format(path):
+    """format of a file from its signature, None if it is not a known one"""
+    with open(path, 'rb') as src:
+        header = src.read(max(offset + len(magic) for values in signatures.values() for offset, magic in values))
+    for name, values in signatures.items():
+        if any(header[offset:offset + len(magic)] == magic for offset, magic in values):
+            return name
+    return None
+
+
+def check_file(path, open_file=True):
+    """check a product file
+
+    Files with a known extension must have the signature of their format.
+    Then the file is opened with rasterio, unless open_file is False
+
+    Returns:
+    str: None for valid files, or the reason why the file is not valid"""
+    try:
+        if os.path.getsize(path) == 0:
+            return 'empty file'
+        expected = extension_formats.get(os.path.splitext(path)[1].lower())
+        if expected is not None:
+            found = file_format(path)
+            if found not in expected:
+                return f'signature of {found or "unknown"} format'
+        if open_file:
+            with rasterio.open(path):
+                pass
+    except Exception as error:
+        return f'{type(error).__name__}: {error}'
+    return None
+
+
+def validate_files(paths, workers=4, open_file=True):
+    """check product files, on a pool of processes when workers > 1
+
+    Returns:
+    dict: path -> None if valid, or the reason why it is not"""
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(check_file, paths, [open_file] * len(paths),
+                                   chunksize=max(1, len(paths) // (4 * workers)))
+            return dict(zip(paths, results))
+    return {path: check_file(path, open_file) for path in paths}
+
+
+def validate_folder(folder, extension=None, workers=4, open_file=True, delete=False, database=None):
+    """check the files of a product folder that were not checked in their current version
+
+    A file is checked again only if its size or mtime differ from the
+    fingerprint recorded when it was found valid. Corrupt files are moved to
+    the quarantine folder of the product, or deleted
+
+    Parameters:
+    folder (str): product folder
+    extension (str): only check files containing extension (e.g. '.hdf')
+    workers (int): processes checking files
+    open_file (bool): open files with rasterio after the signature check
+    delete (bool): delete corrupt files instead of moving them to quarantine
+    database (str): file catalog database. Default is ~/catalogHidroCL/files.sqlite
+
+    Returns:
+    dict: name -> reason of the corrupt files"""
+    start = time.time()
+    folder = os.path.abspath(folder)
+    with catalog.FileCatalog(database) as files_catalog:
+        names = files_catalog.files(folder, extension)
+        recorded = files_catalog.fingerprints(folder)
+        pending = []
+        changed = []
+        for name in names:
+            stat = os.stat(os.path.join(folder, name))
+            size, mtime, status = recorded[name]
+            if (size, mtime) != (stat.st_size, stat.st_mtime):
+                changed.append(files_catalog.row(folder, name, stat.st_size, stat.st_mtime))
+            elif status == 'valid':
+                continue
+            pending.append(name)
+        with files_catalog.connection:
+            files_catalog.upsert(changed)
+        print(f'Checking {len(pending)} of {len(names)} files in {folder}')
+
+        results = validate_files([os.path.join(folder, name) for name in pending], workers, open_file)
+        corrupt = {os.path.basename(path): reason for path, reason in results.items() if reason is not None}
+        files_catalog.set_statuses(folder, [(name, 'valid') for name in pending if name not in corrupt])
+        for name, reason in corrupt.items():
+            print(f'Corrupt file {name}: {reason}')
+        catalog.quarantine_files(folder, list(corrupt), delete, files_catalog)
+    print(f'Checked {len(pending)} files in {round(time.time() - start)} seconds, {len(corrupt)} corrupt')
+    return corrupt
@@ -0,0 +1,698 @@
+"""
+zonal statistics engine for hidrocl extractions
+what does it do?
+ - turns the catchment polygons into a sparse catchment x pixel matrix of
+   coverage fractions, once per polygon file and raster grid
+ - keeps those matrices in an on-disk index per polygon file and grid, so
+   they are computed once per deployment
+ - computes the statistics of every scene as sparse matrix products over
+   the mosaic array, without calling Rscript
+ - keeps per catchment partial aggregates of raster parts (e.g. one MODIS
+   tile) that merge into the same statistics, so a scene can be reduced
+   tile by tile without a full mosaic
+ - streams dask-backed rasters block by block through those partials, so
+   lazy mosaics are never computed whole. Blocks of several rasters are
+   computed together and reduced with several weights, so the products and
+   polygon layers of a scene share one read of each block
+ - returns results as in-memory tables, or writes them with the same layout
+   as the Weighted*Extraction.R scripts, so write_line can read both
+"""
+
+import os
+import json
+import dask
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rioxarray as rioxr
+from math import floor, ceil
+from pathlib import Path
+from scipy import sparse
+from rasterio import features
+from rasterio.transform import Affine
+
+_weights_cache = {}
+
+index_dtype = np.dtype([('catchment', 'int32'), ('pixel', 'int64'), ('coverage', 'float32')])
+
+
+class ZonalWeights:
+    """A class to hold the coverage fractions of catchment polygons over a raster grid
+
+    Parameters:
+    gauge_ids (list): catchment ids, in the same order as the polygons
+    rows (numpy.ndarray): catchment index of each weight
+    pixels (numpy.ndarray): flat pixel offset in the grid of each weight
+    coverage (numpy.ndarray): coverage fraction of each weight
+    transform (Affine): grid transform
+    shape (tuple): grid shape as (rows, columns)"""
+
+    def __init__(self, gauge_ids, rows, pixels, coverage, transform, shape):
+        self.gauge_ids = [str(s) for s in gauge_ids]
+        self.transform = transform
+        self.shape = tuple(shape)
+        # only pixels touched by a catchment are kept, so scenes are reduced to them before any product
+        self.pixels, columns = np.unique(pixels, return_inverse=True)
+        matrix_shape = (len(self.gauge_ids), len(self.pixels))
+        self.matrix = sparse.csr_matrix((np.asarray(coverage, dtype='float64'), (rows, columns)),
+                                        shape=matrix_shape)
+        self.touched = sparse.csr_matrix((np.ones(len(columns)), (rows, columns)), shape=matrix_shape)
+        self.counts = np.asarray(self.touched.sum(axis=1)).ravel()
+        self.column_matrices = None
+
+    def __repr__(self):
+        return f'Zonal weights: {len(self.gauge_ids)} catchments over {len(self.pixels)} pixels'
+
+    def values(self, raster):
+        """pick the values of the weighted pixels from a raster array"""
+        raster = np.asarray(raster)
+        if raster.size != self.shape[0] * self.shape[1]:
+            raise ValueError(f'Raster of size {raster.size} does not match the weights grid {self.shape}')
+        return raster.reshape(-1)[self.pixels]
+
+    def columns(self, start, stop):
+        """coverage and touched matrices of the weighted pixels start to stop (positions in self.pixels)"""
+        if self.column_matrices is None:
+            self.column_matrices = (self.matrix.tocsc(), self.touched.tocsc())
+        matrix, touched = self.column_matrices
+        return matrix[:, start:stop].tocsr(), touched[:, start:stop].tocsr()
+
+
+def grid_signature(transform, shape):
+    """return a string identifying a raster grid"""
+    coefficients = ','.join(f'{value:.6f}' for value in tuple(transform)[:6])
+    return f'{coefficients};{shape[0]}x{shape[1]}'
+
+
+def build_weights(polygons_path, transform, shape, crs=None, subpixels=10, strip=256):
+    """compute the coverage fraction of each polygon over a grid
+
+    Each polygon is rasterized over its bounding window at subpixels x subpixels
+    cells per pixel, in strips of rows to keep memory low, and the fraction of
+    covered cells is used as weight.
+
+    Parameters:
+    polygons_path (str): path to the polygons, with a gauge_id field
+    transform (Affine): grid transform
+    shape (tuple): grid shape as (rows, columns)
+    crs: grid crs. If given, polygons are reprojected when needed
+    subpixels (int): cells per pixel side used to compute the fractions
+    strip (int): pixel rows rasterized at once"""
+    polys = gpd.read_file(polygons_path)
+    if crs is not None and polys.crs is not None and polys.crs != crs:
+        polys = polys.to_crs(crs)
+
+    inverse = ~transform
+    nrows, ncols = shape
+    rows, pixels, coverage = [], [], []
+
+    for index, geom in enumerate(polys.geometry):
+        if geom is None or geom.is_empty:
+            continue
+        xmin, ymin, xmax, ymax = geom.bounds
+        col0, row0 = inverse * (xmin, ymax)
+        col1, row1 = inverse * (xmax, ymin)
+        col_off = max(floor(min(col0, col1)), 0)
+        col_end = min(ceil(max(col0, col1)), ncols)
+        row_start = max(floor(min(row0, row1)), 0)
+        row_end = min(ceil(max(row0, row1)), nrows)
+        width = col_end - col_off
+        for row_off in range(row_start, row_end, strip):
+            height = min(strip, row_end - row_off)
+            if width <= 0 or height <= 0:
+                continue
+            fine = features.rasterize([(geom, 1)],
+                                      out_shape=(height * subpixels, width * subpixels),
+                                      transform=transform
+                                      * Affine.translation(col_off, row_off)
+                                      * Affine.scale(1 / subpixels),
+                                      fill=0,
+                                      dtype='uint8')
+            fraction = fine.reshape(height, subpixels, width, subpixels).sum(axis=(1, 3)) / subpixels ** 2
+            r, c = np.nonzero(fraction)
+            rows.append(np.full(len(r), index))
+            pixels.append((r + row_off).astype('int64') * ncols + c + col_off)
+            coverage.append(fraction[r, c])
+
+    if len(rows) == 0:
+        rows, pixels, coverage = [np.empty(0, dtype='int64')], [np.empty(0, dtype='int64')], [np.empty(0)]
+
+    return ZonalWeights(polys.gauge_id.tolist(),
+                        np.concatenate(rows),
+                        np.concatenate(pixels),
+                        np.concatenate(coverage),
+                        transform,
+                        shape)
+
+
+def weights_folder():
+    """set folder for weight indexes"""
+    home = str(Path.home())  # get user's home path
+    weights_path = os.path.join(home, 'weightsHidroCL')
+
+    if not os.path.exists(weights_path):
+        os.makedirs(weights_path)
+        print(f'Weights folder {weights_path} not found, creating it')
+    return weights_path
+
+
+def polygons_hash(polygons_path):
+    """hash a polygon file together with its sidecar files (.dbf, .shx, .prj, ...)"""
+    folder, name = os.path.split(os.path.abspath(polygons_path))
+    stem = os.path.splitext(name)[0]
+    files = sorted(value for value in os.listdir(folder) if os.path.splitext(value)[0] == stem)
+    sha = hashlib.sha1()
+    for file in files:
+        sha.update(file.encode())
+        with open(os.path.join(folder, file), 'rb') as the_file:
+            for block in iter(lambda: the_file.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def weight_index_path(folder, polygons_path, transform, shape):
+    """return the index path for a polygon file over a grid"""
+    key = polygons_hash(polygons_path) + grid_signature(transform, shape)
+    return os.path.join(folder, 'weights_' + hashlib.sha1(key.encode()).hexdigest()[:20] + '.npy')
+
+
+def save_weight_index(weights, index_path):
+    """write weights as (catchment, pixel offset, coverage fraction) triplets
+
+    The triplets go to a .npy file and the gauge ids and grid to a .json file
+    next to it. Both are written to temporary files of this process and
+    renamed, the .json last, so an index is only found when complete, even
+    when several processes write it at once."""
+    coo = weights.matrix.tocoo()
+    triplets = np.empty(coo.nnz, dtype=index_dtype)
+    triplets['catchment'] = coo.row
+    triplets['pixel'] = weights.pixels[coo.col]
+    triplets['coverage'] = coo.data
+    header = {'gauge_ids': weights.gauge_ids,
+              'transform': list(weights.transform)[:6],
+              'shape': list(weights.shape),
+              'signature': grid_signature(weights.transform, weights.shape)}
+
+    tmp = f'.{os.getpid()}.tmp'
+    with open(index_path + tmp, 'wb') as the_file:
+        np.save(the_file, triplets)
+    os.replace(index_path + tmp, index_path)
+    header_path = os.path.splitext(index_path)[0] + '.json'
+    with open(header_path + tmp, 'w') as the_file:
+        json.dump(header, the_file)
+    os.replace(header_path + tmp, header_path)
+
+
+def load_weight_index(index_path):
+    """load weights from an index written by save_weight_index, memory-mapping the triplets"""
+    with open(os.path.splitext(index_path)[0] + '.json') as the_file:
+        header = json.load(the_file)
+    triplets = np.load(index_path, mmap_mode='r')
+    return ZonalWeights(header['gauge_ids'],
+                        triplets['catchment'],
+                        triplets['pixel'],
+                        triplets['coverage'],
+                        Affine(*header['transform']),
+                        header['shape'])
+
+
+def get_weights(polygons_path, transform, shape, crs=None, folder=None):
+    """return the weights of a polygon file over a grid
+
+    Weights are looked up in memory, then in the weight index folder, and
+    only computed (and saved to the folder) when the polygon file or the
+    grid changed.
+
+    Parameters:
+    polygons_path (str): path to the polygons, with a gauge_id field
+    transform (Affine): grid transform
+    shape (tuple): grid shape as (rows, columns)
+    crs: grid crs
+    folder (str): weight index folder. Default is ~/weightsHidroCL"""
+    stat = os.stat(polygons_path)
+    key = (os.path.abspath(polygons_path), stat.st_mtime, stat.st_size, grid_signature(transform, shape))
+    if key not in _weights_cache:
+        if folder is None:
+            folder = weights_folder()
+        index_path = weight_index_path(folder, polygons_path, transform, shape)
+        if os.path.exists(os.path.splitext(index_path)[0] + '.json'):
+            print(f'Loading weights from {index_path}')
+            _weights_cache[key] = load_weight_index(index_path)
+        else:
+            print(f'Computing weights for {polygons_path}')
+            save_weight_index(build_weights(polygons_path, transform, shape, crs), index_path)
+            # reloaded so every scene uses the stored (float32) coverage fractions
+            _weights_cache[key] = load_weight_index(index_path)
+    return _weights_cache[key]
+
+
+def raster_weights(polygons_path, raster):
+    """return the weights of a polygon file over the grid of a rioxarray raster"""
+    return get_weights(polygons_path,
+                       raster.rio.transform(),
+                       (raster.rio.height, raster.rio.width),
+                       raster.rio.crs)
+
+
+def weighted_mean(weights, raster):
+    """compute the weighted mean and pixel count of each catchment
+
+    Same as custom_mean and count_na in WeightedMeanExtraction.R: the mean is
+    weighted by coverage fraction and rounded, and the pixel count is the per
+    mille of valid pixels over the pixels touched by the catchment.
+
+    Returns:
+    (numpy.ndarray, numpy.ndarray): mean and pixel count"""
+    return _weighted_mean(weights, weights.values(raster).astype('float64'))
+
+
+def _weighted_mean(weights, values, scale=1):
+    """weighted mean and pixel count from the values of the weighted pixels
+
+    values may have one column per raster, and so do the results. The mean
+    is multiplied by scale before rounding"""
+    valid = (~np.isnan(values)).astype('float64')
+    counts = weights.counts if values.ndim == 1 else weights.counts[:, np.newaxis]
+    weight_sum = weights.matrix @ valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.round(scale * (weights.matrix @ np.nan_to_num(values)) / weight_sum)
+        pc = np.round((weights.touched @ valid) / counts * 1000)
+    return mean, pc
+
+
+def weighted_means(weights, rasters):
+    """compute weighted_mean of several rasters on the same grid in one pass
+
+    The weighted pixels of every raster are stacked as columns, so each
+    sparse product covers all rasters at once.
+
+    Returns:
+    (numpy.ndarray, numpy.ndarray): mean and pixel count with one column per raster"""
+    values = np.column_stack([weights.values(raster) for raster in rasters]).astype('float64')
+    return _weighted_mean(weights, values)
+
+
+def weighted_percent(weights, raster):
+    """compute the weighted percent of pixels equal to 1 in each catchment
+
+    Same as custom_sum in WeightedPercExtraction.R: coverage of pixels equal
+    to 1 over the number of pixels touched by the catchment, in percent and
+    rounded. Catchments without pixels get 0"""
+    return _weighted_percent(weights, weights.values(raster))
+
+
+def _weighted_percent(weights, values):
+    """weighted percent from the values of the weighted pixels"""
+    ones = (values == 1).astype('float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percent = np.round(100 * (weights.matrix @ ones) / weights.counts)
+    percent[weights.counts == 0] = 0
+    return percent
+
+
+def zone_sets_percent(weights_list, raster):
+    """compute weighted_percent for several zone sets over the same raster
+
+    The raster is read once and each zone set (e.g. north and south faces)
+    only picks its own pixels from it
+
+    Returns:
+    list: one array of percents per zone set"""
+    raster = np.asarray(raster)
+    return [_weighted_percent(weights, weights.values(raster)) for weights in weights_list]
+
+
+def quantile_names(quantiles):
+    """return result column names for quantiles, as exactextractr (0.1 -> q10)"""
+    return [f'q{100 * q:g}' for q in quantiles]
+
+
+def weighted_statistics(weights, raster, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9), scale=1):
+    """compute weighted mean, pixel count and weighted quantiles of each catchment in one pass
+
+    Mean and pixel count are the same as weighted_mean. Quantiles follow
+    exactextractr: the n valid pixels of a catchment are sorted by value and,
+    with coverage w_i and cumulative coverage W_i, each gets
+    s_i = i * w_i + (n - 1) * W_(i-1); quantile q is interpolated at q * s_n.
+    Pixels of all catchments are sorted together, once, by (catchment, value).
+    Mean and quantiles are multiplied by scale.
+
+    Returns:
+    (numpy.ndarray, numpy.ndarray, numpy.ndarray): mean, pixel count and
+    quantiles with one column per quantile"""
+    return _weighted_statistics(weights, weights.values(raster).astype('float64'), quantiles, scale)
+
+
+def _weighted_statistics(weights, values, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9), scale=1):
+    """weighted mean, pixel count and quantiles from the values of the weighted pixels"""
+    mean, pc = _weighted_mean(weights, values, scale)
+
+    matrix = weights.matrix
+    rows = np.repeat(np.arange(len(weights.gauge_ids)), np.diff(matrix.indptr))
+    x = values[matrix.indices]
+    valid = ~np.isnan(x)
+    return mean, pc, scale * _weighted_quantiles(len(weights.gauge_ids), rows[valid], x[valid], matrix.data[valid],
+                                                 quantiles)
+
+
+def _weighted_quantiles(ncatch, rows, x, w, quantiles):
+    """weighted quantiles from the catchment, value and coverage of the valid weighted pixels"""
+    quantiles = np.asarray(quantiles, dtype='float64')
+    order = np.lexsort((x, rows))
+    rows, x, w = rows[order], x[order], w[order]
+    n = np.bincount(rows, minlength=ncatch)
+    start = np.concatenate(([0], np.cumsum(n)[:-1]))
+    position = np.arange(len(x)) - start[rows]
+    cumulative = np.cumsum(w)
+    previous = cumulative - w - (cumulative[start[rows]] - w[start[rows]])
+    s = position * w + (n[rows] - 1) * previous
+
+    result = np.full((ncatch, len(quantiles)), np.nan)
+    single = n == 1
+    result[single] = x[start[single]][:, np.newaxis]
+    many = np.flatnonzero(n > 1)
+    if len(many) > 0:
+        # catchments are laid side by side as 2 * row + s / s_n, so one searchsorted finds every quantile
+        last = start + n - 1
+        key = 2 * rows + s / s[last[rows]]
+        desired = (2 * many[:, np.newaxis] + quantiles[np.newaxis, :]).ravel()
+        first_index = np.repeat(start[many], len(quantiles))
+        last_index = np.repeat(last[many], len(quantiles))
+        right = np.clip(np.searchsorted(key, desired, side='right'), first_index + 1, last_index)
+        left = right - 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.clip((desired - key[left]) / (key[right] - key[left]), 0, 1)
+        fraction = np.where(key[right] > key[left], fraction, 0)
+        value = x[left] + fraction * (x[right] - x[left])
+        result[many] = value.reshape(len(many), len(quantiles))
+    return result
+
+
+class ZonalPartials:
+    """A class to hold mergeable per catchment aggregates of a part of a raster
+
+    Partials of disjoint parts (e.g. the MODIS tiles of a scene) computed with
+    weights of the same polygon file are merged with +, and give the same
+    statistics as weighted_mean, weighted_percent and weighted_statistics
+    over the whole raster.
+
+    Parameters:
+    gauge_ids (list): catchment ids
+    weighted_sum (numpy.ndarray): sum of coverage x value of valid pixels
+    weight_sum (numpy.ndarray): sum of coverage of valid pixels
+    valid (numpy.ndarray): number of valid pixels touched
+    touched (numpy.ndarray): number of pixels touched
+    ones (numpy.ndarray): sum of coverage of pixels equal to 1
+    sketch (tuple): catchment, value and coverage arrays of the valid pixels,
+    needed for quantiles. None if not kept"""
+
+    def __init__(self, gauge_ids, weighted_sum, weight_sum, valid, touched, ones, sketch=None):
+        self.gauge_ids = gauge_ids
+        self.weighted_sum = weighted_sum
+        self.weight_sum = weight_sum
+        self.valid = valid
+        self.touched = touched
+        self.ones = ones
+        self.sketch = sketch
+
+    def __repr__(self):
+        return f'Zonal partials of {len(self.gauge_ids)} catchments over {int(self.touched.sum())} pixels'
+
+    def __add__(self, other):
+        if self.gauge_ids != other.gauge_ids:
+            raise ValueError('Partials of different catchments cannot be merged')
+        sketch = None
+        if self.sketch is not None and other.sketch is not None:
+            sketch = tuple(np.concatenate(pair) for pair in zip(self.sketch, other.sketch))
+        return ZonalPartials(self.gauge_ids,
+                             self.weighted_sum + other.weighted_sum,
+                             self.weight_sum + other.weight_sum,
+                             self.valid + other.valid,
+                             self.touched + other.touched,
+                             self.ones + other.ones,
+                             sketch)
+
+    def mean(self, scale=1):
+        """weighted mean and pixel count, as weighted_mean"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (np.round(scale * self.weighted_sum / self.weight_sum),
+                    np.round(self.valid / self.touched * 1000))
+
+    def percent(self):
+        """weighted percent of pixels equal to 1, as weighted_percent"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            percent = np.round(100 * self.ones / self.touched)
+        percent[self.touched == 0] = 0
+        return percent
+
+    def quantiles(self, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9), scale=1):
+        """weighted quantiles with one column per quantile, as weighted_statistics"""
+        if self.sketch is None:
+            raise ValueError('Partials were computed without quantile sketch')
+        return scale * _weighted_quantiles(len(self.gauge_ids), *self.sketch, quantiles)
+
+
+def zonal_partials(weights, raster, sketch=False):
+    """compute the partial aggregates of each catchment over a raster part
+
+    Parameters:
+    weights (ZonalWeights): weights over the grid of the raster part
+    raster (numpy.ndarray): raster part
+    sketch (bool): keep the valid pixels for quantiles"""
+    return _partials(weights.gauge_ids, weights.matrix, weights.touched, weights.values(raster), sketch)
+
+
+def _partials(gauge_ids, matrix, touched, values, sketch=False):
+    """partial aggregates from coverage and touched matrices and the values of their pixels"""
+    values = values.astype('float64')
+    valid = (~np.isnan(values)).astype('float64')
+    pixels_sketch = None
+    if sketch:
+        rows = np.repeat(np.arange(len(gauge_ids)), np.diff(matrix.indptr))
+        x = values[matrix.indices]
+        keep = ~np.isnan(x)
+        pixels_sketch = (rows[keep], x[keep], matrix.data[keep])
+    return ZonalPartials(gauge_ids,
+                         matrix @ np.nan_to_num(values),
+                         matrix @ valid,
+                         touched @ valid,
+                         np.asarray(touched.sum(axis=1), dtype='float64').ravel(),
+                         matrix @ (values == 1).astype('float64'),
+                         pixels_sketch)
+
+
+def lazy_partials(weights, raster, sketch=False):
+    """compute the partial aggregates of each catchment over a dask-backed raster
+
+    Blocks of rows are computed one at a time and reduced with the weights of
+    their pixels, so the raster is never held whole in memory
+
+    Parameters:
+    weights (ZonalWeights): weights over the grid of the raster
+    raster: dask-backed rioxarray raster, integer nodata is read as missing
+    sketch (bool): keep the valid pixels for quantiles"""
+    return lazy_partials_sets([weights], [raster], sketch)[0][0]
+
+
+def lazy_partials_sets(weights_list, rasters, sketch=False):
+    """compute the partial aggregates of several dask-backed rasters on the same grid
+    for several weights, in one pass over their blocks of rows
+
+    The blocks of every raster are computed together, so rasters built from
+    the same blocks (e.g. the products of a lazy ModisMosaic) read each block
+    once, and each block is reduced with every weights
+
+    Parameters:
+    weights_list (list): ZonalWeights over the grid of the rasters
+    rasters (list): dask-backed rioxarray rasters, integer nodata is read as missing
+    sketch (bool): keep the valid pixels for quantiles
+
+    Returns:
+    list: for each raster, the list of partials of each weights"""
+    datas = []
+    for raster in rasters:
+        data = raster.data
+        for weights in weights_list:
+            if data.shape[-2:] != weights.shape:
+                raise ValueError(f'Raster of shape {data.shape[-2:]} does not match the weights grid {weights.shape}')
+        datas.append(data.reshape(data.shape[-2:]))
+    chunks = datas[0].chunks[0]
+    datas = [data if data.chunks[0] == chunks else data.rechunk((chunks, data.chunks[1])) for data in datas]
+    nodatas = [integer_nodata(raster) for raster in rasters]
+    width = weights_list[0].shape[1]
+    empty = np.empty(0)
+    partials = [[ZonalPartials(weights.gauge_ids, *[np.zeros(len(weights.gauge_ids)) for _ in range(5)],
+                               (empty.astype('int64'), empty, empty) if sketch else None)
+                 for weights in weights_list] for _ in rasters]
+    row0 = 0
+    for height in chunks:
+        spans = [np.searchsorted(weights.pixels, [row0 * width, (row0 + height) * width])
+                 for weights in weights_list]
+        if any(stop > start for start, stop in spans):
+            blocks = dask.compute(*[data[row0:row0 + height] for data in datas])
+            for i, block in enumerate(blocks):
+                block = np.asarray(block).reshape(-1)
+                for j, (weights, (start, stop)) in enumerate(zip(weights_list, spans)):
+                    if stop > start:
+                        matrix, touched = weights.columns(start, stop)
+                        values = decode(block[weights.pixels[start:stop] - row0 * width], nodatas[i])
+                        partials[i][j] = partials[i][j] + _partials(weights.gauge_ids, matrix, touched, values,
+                                                                    sketch)
+        row0 += height
+    return partials
+
+
+def is_lazy(raster):
+    """check if a rioxarray raster is dask-backed"""
+    return raster.chunks is not None
+
+
+def integer_nodata(raster):
+    """nodata of an integer rioxarray raster, None for float rasters (nan is missing)"""
+    if np.issubdtype(raster.dtype, np.floating):
+        return None
+    return raster.rio.nodata
+
+
+def raster_scale(raster):
+    """scale factor of a rioxarray raster, applied to the statistics and not to the pixels"""
+    return raster.attrs.get('scale_factor', 1)
+
+
+def decode(values, nodata=None):
+    """values of weighted pixels as float, with nodata as nan"""
+    values = values.astype('float64')
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    return values
+
+
+def raster_values(weights, raster):
+    """values of the weighted pixels of a rioxarray raster as float, with integer nodata as nan"""
+    return decode(weights.values(raster.values), integer_nodata(raster))
+
+
+def mean_result(polygons_path, raster):
+    """weighted mean and pixel count of a rioxarray raster, as a result table (gauge_id, mean, pc)
+
+    Integer rasters keep their own type up to here: nodata is read as missing
+    and the scale_factor attribute is applied to the means"""
+    weights = raster_weights(polygons_path, raster)
+    if is_lazy(raster):
+        return partials_mean_result(lazy_partials(weights, raster), raster_scale(raster))
+    mean, pc = _weighted_mean(weights, raster_values(weights, raster), raster_scale(raster))
+    return pd.DataFrame({'gauge_id': weights.gauge_ids, 'mean': mean, 'pc': pc})
+
+
+def mean_results(polygons_path, rasters):
+    """weighted mean and pixel count of several rioxarray rasters on the same grid in one pass
+
+    Parameters:
+    polygons_path (str): path to the polygons, with a gauge_id field
+    rasters (dict): name -> raster
+
+    Returns:
+    dict: name -> result table (gauge_id, mean, pc)"""
+    names = list(rasters)
+    weights = raster_weights(polygons_path, rasters[names[0]])
+    if all(is_lazy(raster) for raster in rasters.values()):
+        partials = lazy_partials_sets([weights], [rasters[name] for name in names])
+        return {name: partials_mean_result(partials[i][0], raster_scale(rasters[name]))
+                for i, name in enumerate(names)}
+    if any(is_lazy(raster) for raster in rasters.values()):
+        return {name: mean_result(polygons_path, rasters[name]) for name in names}
+    values = np.column_stack([raster_values(weights, rasters[name]) for name in names])
+    mean, pc = _weighted_mean(weights, values, np.array([raster_scale(rasters[name]) for name in names]))
+    return {name: pd.DataFrame({'gauge_id': weights.gauge_ids, 'mean': mean[:, i], 'pc': pc[:, i]})
+            for i, name in enumerate(names)}
+
+
+def quantile_result(polygons_path, raster, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    """weighted quantiles of a rioxarray raster, as a result table (gauge_id, q...)"""
+    result = statistics_result(polygons_path, raster, quantiles)
+    return result.drop(columns=['mean', 'pc'])
+
+
+def statistics_result(polygons_path, raster, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    """weighted mean, pixel count and quantiles of a rioxarray raster in one pass,
+    as a result table (gauge_id, mean, pc, q...)"""
+    weights = raster_weights(polygons_path, raster)
+    if is_lazy(raster):
+        return partials_statistics_result(lazy_partials(weights, raster, sketch=True), quantiles,
+                                          raster_scale(raster))
+    mean, pc, result = _weighted_statistics(weights, raster_values(weights, raster), quantiles,
+                                            raster_scale(raster))
+    return pd.DataFrame({'gauge_id': weights.gauge_ids, 'mean': mean, 'pc': pc,
+                         **dict(zip(quantile_names(quantiles), result.T))})
+
+
+def percent_results(polygons_paths, raster):
+    """weighted percent of a rioxarray raster for several polygon layers,
+    as one result table (gauge_id, result) per layer"""
+    weights_list = [raster_weights(polygons_path, raster) for polygons_path in polygons_paths]
+    if is_lazy(raster):
+        return [partials_percent_result(partials) for partials in lazy_partials_sets(weights_list, [raster])[0]]
+    percents = zone_sets_percent(weights_list, raster.values)
+    return [pd.DataFrame({'gauge_id': weights.gauge_ids, 'result': percent})
+            for weights, percent in zip(weights_list, percents)]
+
+
+def partials_mean_result(partials, scale=1):
+    """weighted mean and pixel count of merged partials, as a result table (gauge_id, mean, pc)"""
+    mean, pc = partials.mean(scale)
+    return pd.DataFrame({'gauge_id': partials.gauge_ids, 'mean': mean, 'pc': pc})
+
+
+def partials_statistics_result(partials, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9), scale=1):
+    """weighted mean, pixel count and quantiles of merged partials, as a result table (gauge_id, mean, pc, q...)"""
+    mean, pc = partials.mean(scale)
+    result = partials.quantiles(quantiles, scale)
+    return pd.DataFrame({'gauge_id': partials.gauge_ids, 'mean': mean, 'pc': pc,
+                         **dict(zip(quantile_names(quantiles), result.T))})
+
+
+def partials_percent_result(partials):
+    """weighted percent of merged partials, as a result table (gauge_id, result)"""
+    return pd.DataFrame({'gauge_id': partials.gauge_ids, 'result': partials.percent()})
+
+
+def write_result(result_file, result):
+    """write a result table with the layout of the R extraction scripts"""
+    result.to_csv(result_file, index=False, na_rep='NA')
+
+
+def weighted_mean_extraction(polygons_path, raster_path, result_file):
+    """python counterpart of WeightedMeanExtraction.R"""
+    with rioxr.open_rasterio(raster_path, masked=True) as src:
+        write_result(result_file, mean_result(polygons_path, src))
+
+
+def weighted_quantile_extraction(polygons_path, raster_path, result_file, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    """python counterpart of WeightedQuanExtraction.R"""
+    with rioxr.open_rasterio(raster_path, masked=True) as src:
+        write_result(result_file, quantile_result(polygons_path, src, quantiles))
+
+
+def weighted_statistics_extraction(polygons_path, raster_path, result_file, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    """weighted mean, pixel count and quantiles in one pass
+
+    The result has gauge_id, mean, pc and one column per quantile"""
+    with rioxr.open_rasterio(raster_path, masked=True) as src:
+        write_result(result_file, statistics_result(polygons_path, src, quantiles))
+
+
+def weighted_percent_extraction(polygons_paths, raster_path, result_files):
+    """python counterpart of WeightedPercExtraction.R for several polygon layers
+
+    The raster is read once for all polygon layers, and one result file is
+    written per layer
+
+    Parameters:
+    polygons_paths (list): polygon layers, e.g. [hidrocl_north, hidrocl_south]
+    raster_path (str): raster for extraction
+    result_files (list): one output file per polygon layer"""
+    with rioxr.open_rasterio(raster_path, masked=True) as src:
+        results = percent_results(polygons_paths, src)
+    for result, result_file in zip(results, result_files):
+        write_result(result_file, result)
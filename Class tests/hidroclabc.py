@@ -19,47 +19,92 @@ import re
 import os
 import gc
 import sys
-import csv
 import time
 import copy
+import threading
 import subprocess
+import numpy as np
 import pandas as pd
-from math import ceil
 from pathlib import Path
+from itertools import repeat
+from contextlib import ExitStack
 import rioxarray as rioxr
 from datetime import datetime
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 from rioxarray.merge import merge_arrays
 from sklearn.linear_model import LinearRegression
+from concurrent.futures import ProcessPoolExecutor
 
 import hidrocl_paths as hcl
+import hidrocl_catalog as catalog
+import hidrocl_zonal as zonal
+import hidrocl_storage as storage
+import hidrocl_mosaic as mosaic
+import hidrocl_rworker as rworker
+import hidrocl_validation as validation
 
 
 # hcl_object = collections.namedtuple('HCLObs',['name','date','value'])
 
+def read_observations(store, observations=None, state=None):
+    """read the observations of a database, appending only the new rows to observations read before
+
+    Parameters:
+    store: hidrocl_storage store of the database
+    observations (DataFrame): observations read before, or None
+    state: state of the read of observations
+
+    Returns:
+    tuple: observations and state of this read"""
+    new_observations, state, appended = store.read_new(state if observations is not None else None)
+    if not appended:
+        return new_observations, state
+    if len(observations) == 0:
+        return new_observations, state
+    if len(new_observations) > 0:
+        observations = pd.concat([observations, new_observations])
+    return observations, state
+
+
 class HidroCLVariable:
     """A class to hold information about a hidrocl variable
 
+    Databases are CSV files, parquet stores if their path ends with .parquet,
+    or binary matrix stores if it ends with .matrix (see hidrocl_storage)
+
     Parameters:
     name (str): name of the variable
     database (str): path to the database
-    pcdatabase (str): path to pixel count database"""
+    pcdatabase (str): path to pixel count database
+    dtype (str): value type of the variable, for rounding and nodata of its values"""
 
-    def __init__(self, name, database, pcdatabase):
+    def __init__(self, name, database, pcdatabase, dtype='int32'):
         self.name = name
         self.database = database
         self.pcdatabase = pcdatabase
-        self.indatabase = ''
+        self.dtype = dtype
+        self.store = storage.open_store(database)
+        self.pcstore = storage.open_store(pcdatabase)
+        self.indatabase = set()
         self.observations = None
         self.pcobservations = None
+        self.read_state = None
+        self.pcread_state = None
         self.catchment_names = None
+        self.gauge_ids = None
         self.checkdatabase()
         self.checkpcdatabase()
 
     def __repr__(self):
         return f'Variable: {self.name}. Records: {len(self.indatabase)}'
 
+    def __getstate__(self):
+        # observations are not sent to scene worker processes, which only need the ids in the database
+        state = self.__dict__.copy()
+        state.update(observations=None, pcobservations=None, read_state=None, pcread_state=None)
+        return state
+
     def __str__(self):
         return f'''
 Variable {self.name}.
@@ -72,51 +117,44 @@ Pixel count database path: {self.pcdatabase}.
         """add catchment names to the variable"""
         if self.catchment_names is None:
             self.catchment_names = catchment_names_list
+            self.gauge_ids = np.asarray(catchment_names_list, dtype=str)
             print('Catchment names added. I recommend you to check the database')
         else:
             print('Catchment names already added!')
 
     def checkdatabase(self):
-        """check database"""
-        if os.path.exists(self.database):  # check if db exists
+        """check database
+
+        Observations read before are kept and only the rows appended since
+        then are read, unless the database was replaced or rewritten"""
+        if self.store.exists():  # check if db exists
             print('Database found, using ' + self.database)
-            self.observations = pd.read_csv(self.database)
-            self.observations.date = pd.to_datetime(self.observations.date, format='%Y-%m-%d')
-            self.observations.set_index(['date'], inplace=True)
-            self.indatabase = self.observations[self.observations.columns[0]].values.tolist()
+            self.observations, self.read_state = read_observations(self.store, self.observations,
+                                                                   self.read_state)
+            self.indatabase = self.store.ids()
             self.catchment_names = self.observations.columns[1:].tolist()
+            self.gauge_ids = np.asarray(self.catchment_names, dtype=str)
             print('Observations and catchment names added!')
         else:  # create db
             if self.catchment_names is None:
                 print('Database not found. Please, add catchment names before creating the database')
             else:
                 print('Database not found, creating it for ' + self.database)
-                header_line = [str(s) for s in self.catchment_names]
-                header_line.insert(0, 'name_id')
-                header_line.insert(1, 'date')
-                header_line = ','.join(header_line) + '\n'
-                with open(self.database, 'w') as the_file:
-                    the_file.write(header_line)
+                self.store.create(self.catchment_names, dtype=self.dtype)
                 print('Database created!')
 
     def checkpcdatabase(self):
-        """check database"""
-        if os.path.exists(self.pcdatabase):  # check if db exists
+        """check database, reading only the rows appended since the last check"""
+        if self.pcstore.exists():  # check if db exists
             print('Pixel count database found, using ' + self.pcdatabase)
-            self.pcobservations = pd.read_csv(self.pcdatabase)
-            self.pcobservations.date = pd.to_datetime(self.pcobservations.date, format='%Y-%m-%d')
-            self.pcobservations.set_index(['date'], inplace=True)
+            self.pcobservations, self.pcread_state = read_observations(self.pcstore, self.pcobservations,
+                                                                       self.pcread_state)
         else:  # create db
             if self.catchment_names is None:
                 print('Pixel count database not found. Please, add catchment names before creating the database')
             else:
                 print('Database not found, creating it for ' + self.pcdatabase)
-                header_line = [str(s) for s in self.catchment_names]
-                header_line.insert(0, 'name_id')
-                header_line.insert(1, 'date')
-                header_line = ','.join(header_line) + '\n'
-                with open(self.pcdatabase, 'w') as the_file:
-                    the_file.write(header_line)
+                self.pcstore.create(self.catchment_names, dtype='int32')
                 print('Pixel count database created!')
 
     def valid_data(self):
@@ -288,8 +326,14 @@ def linear_regression_imputation(dataframe, min_observations=100):
     return dataframe2
 
 
-def mosaic_raster(raster_list, layer):
-    """function to mosaic files with rioxarray library"""
+def mosaic_raster(raster_list, layer, modis_mosaic=None):
+    """function to mosaic files with rioxarray library
+
+    If a hidrocl_mosaic.ModisMosaic is given, tiles are written into its fixed grid
+    instead of merged with merge_arrays"""
+    if modis_mosaic is not None:
+        return modis_mosaic.build(raster_list, [layer])
+
     raster_single = []
 
     for raster in raster_list:
@@ -300,8 +344,14 @@ def mosaic_raster(raster_list, layer):
     return raster_mosaic
 
 
-def mosaic_nd_raster(raster_list, layer1, layer2):
-    """function to compute normalized difference and mosaic files with rioxarray library"""
+def mosaic_nd_raster(raster_list, layer1, layer2, modis_mosaic=None):
+    """function to compute normalized difference and mosaic files with rioxarray library
+
+    If a hidrocl_mosaic.ModisMosaic is given, tiles are written into its fixed grid
+    instead of merged with merge_arrays"""
+    if modis_mosaic is not None:
+        return mask_nd_mosaic(modis_mosaic.build(raster_list, [layer1, layer2], mosaic.normalized_difference))
+
     raster_single = []
 
     for raster in raster_list:
@@ -317,6 +367,82 @@ def mosaic_nd_raster(raster_list, layer1, layer2):
     return raster_mosaic
 
 
+def mask_nd_mosaic(raster_mosaic):
+    """set nodata and drop normalized difference values out of [-1000, 1000] in a fixed grid mosaic"""
+    raster_mosaic.rio.write_nodata(-32768, inplace=True)
+    inside = (raster_mosaic <= 1000) & (raster_mosaic >= -1000)
+    if is_integer_mosaic(raster_mosaic):
+        return raster_mosaic.where(inside, -32768)
+    return raster_mosaic.where(inside)
+
+
+def is_integer_mosaic(raster_mosaic):
+    """check if a mosaic keeps integer values with a nodata value instead of nan"""
+    return not np.issubdtype(raster_mosaic.dtype, np.floating)
+
+
+def scale_mosaic(raster_mosaic, scale):
+    """scale a mosaic, as mos * scale
+
+    Integer mosaics keep their values and carry the scale as the scale_factor
+    attribute, which hidrocl_zonal applies to the statistics"""
+    if not is_integer_mosaic(raster_mosaic):
+        return raster_mosaic * scale
+    raster_mosaic.attrs['scale_factor'] = scale
+    return raster_mosaic
+
+
+def snow_mosaic(raster_mosaic):
+    """1 for snow (200) and 0 for anything else, nodata included. uint8 for integer mosaics"""
+    if not is_integer_mosaic(raster_mosaic):
+        return (raster_mosaic.where(raster_mosaic == 200) / 200).fillna(0)
+    snow = (raster_mosaic == 200).astype('uint8')
+    snow.rio.write_crs(raster_mosaic.rio.crs, inplace=True)
+    snow.rio.write_transform(raster_mosaic.rio.transform(), inplace=True)
+    return snow
+
+
+def decode_mosaic(raster_mosaic):
+    """float values of an integer mosaic, with nodata as nan and its scale_factor applied
+
+    Used to write rasters for the R scripts and file backends, which expect
+    the same values as the float mosaics"""
+    if not is_integer_mosaic(raster_mosaic):
+        return raster_mosaic
+    scale = raster_mosaic.attrs.get('scale_factor', 1)
+    nodata = raster_mosaic.rio.nodata
+    decoded = raster_mosaic.astype('float64')
+    if nodata is not None:
+        decoded = decoded.where(raster_mosaic != nodata)
+    decoded = decoded * scale
+    decoded.attrs.pop('scale_factor', None)
+    decoded.rio.write_crs(raster_mosaic.rio.crs, inplace=True)
+    decoded.rio.write_transform(raster_mosaic.rio.transform(), inplace=True)
+    if nodata is not None:
+        decoded.rio.write_nodata(nodata, inplace=True)
+    return decoded
+
+
+def nbr_values(nir, mir):
+    """normalized burn ratio of a tile, as mosaic_nd_raster, truncated as written to an int16 raster"""
+    nd = mosaic.normalized_difference(nir, mir)
+    nd = np.where((nd <= 1000) & (nd >= -1000), nd, np.nan)
+    return np.trunc(nd)
+
+
+def snow_values(values):
+    """1 for snow (200) and 0 for anything else in a tile, as the snow mosaic"""
+    return np.where(values == 200, 1.0, 0.0)
+
+
+def write_raster(mos, temporal_raster, dtype=None):
+    """write a mosaic for extraction. dask-backed mosaics are written block by block
+    and integer mosaics are decoded to the values of float mosaics"""
+    mos = decode_mosaic(mos)
+    lock = threading.Lock() if mos.chunks is not None else None
+    mos.rio.to_raster(temporal_raster, compress='LZW', dtype=dtype, lock=lock)
+
+
 def temp_folder():
     """set temporary folder for paths"""
     home = str(Path.home())  # get user's home path
@@ -333,97 +459,300 @@ def temp_folder():
     return temporal_folder
 
 
-def run_WeightedMeanExtraction(temporal_raster, result_file):
-    """run WeightedMeanExtraction"""
-    subprocess.call([hcl.rscript_path,
-                     "--vanilla",
-                     hcl.WeightedMeanExtraction,
-                     hcl.hidrocl_sinusoidal,
-                     temporal_raster,
-                     result_file])
+def start_r_workers(workers=2):
+    """start R sessions that serve run_Weighted*Extraction calls until stop_r_workers
+
+    Packages and polygons are loaded once per session instead of once per
+    scene. RWorker.R is taken from hcl.RWorker, or from the folder of the
+    extraction scripts"""
+    worker_script = getattr(hcl, 'RWorker', os.path.join(os.path.dirname(hcl.WeightedMeanExtraction), 'RWorker.R'))
+    return rworker.start(hcl.rscript_path, worker_script, workers)
 
 
-def run_WeightedQuanExtraction(temporal_raster, result_file):
+def stop_r_workers():
+    """stop R sessions started by start_r_workers"""
+    rworker.stop()
+
+
+def run_rscript(script, function, polygons, temporal_raster, result_file):
+    """run an R extraction script, on the R workers when they are running"""
+    if rworker.pool is not None:
+        rworker.pool.run(function, polygons, temporal_raster, result_file)
+    else:
+        subprocess.call([hcl.rscript_path,
+                         "--vanilla",
+                         script,
+                         polygons,
+                         temporal_raster,
+                         result_file])
+
+
+def check_backend(backend):
+    """check extraction backend
+
+    'r' runs Rscript and 'python' runs the zonal engine in hidrocl_zonal, both
+    through temporary raster and result files. 'memory' runs hidrocl_zonal
+    straight on the mosaic and hands results to write_line as tables. 'tiles'
+    reduces each tile to hidrocl_zonal partials and merges them, without a mosaic"""
+    if backend not in ('r', 'python', 'memory', 'tiles'):
+        raise ValueError(f'Backend {backend} not supported, use r, python, memory or tiles')
+
+
+def run_WeightedMeanExtraction(temporal_raster, result_file, backend='r'):
     """run WeightedMeanExtraction"""
-    subprocess.call([hcl.rscript_path,
-                     "--vanilla",
-                     hcl.WeightedQuanExtraction,
-                     hcl.hidrocl_sinusoidal,
-                     temporal_raster,
-                     result_file])
+    if backend == 'python':
+        zonal.weighted_mean_extraction(hcl.hidrocl_sinusoidal, temporal_raster, result_file)
+        return
+    run_rscript(hcl.WeightedMeanExtraction, 'mean', hcl.hidrocl_sinusoidal, temporal_raster, result_file)
+
+
+def run_WeightedQuanExtraction(temporal_raster, result_file, backend='r'):
+    """run WeightedQuanExtraction"""
+    if backend == 'python':
+        zonal.weighted_quantile_extraction(hcl.hidrocl_sinusoidal, temporal_raster, result_file)
+        return
+    run_rscript(hcl.WeightedQuanExtraction, 'quantile', hcl.hidrocl_sinusoidal, temporal_raster, result_file)
 
 
-def run_WeightedPercExtractionNorth(temporal_raster, result_file):
+def run_WeightedPercExtractionNorth(temporal_raster, result_file, backend='r'):
     """run WeightedSumExtraction for north face"""
-    subprocess.call([hcl.rscript_path,
-                     "--vanilla",
-                     hcl.WeightedPercentExtraction,
-                     hcl.hidrocl_north,
-                     temporal_raster,
-                     result_file])
+    if backend == 'python':
+        zonal.weighted_percent_extraction([hcl.hidrocl_north], temporal_raster, [result_file])
+        return
+    run_rscript(hcl.WeightedPercentExtraction, 'percent', hcl.hidrocl_north, temporal_raster, result_file)
 
 
-def run_WeightedPercExtractionSouth(temporal_raster, result_file):
+def run_WeightedPercExtractionSouth(temporal_raster, result_file, backend='r'):
     """run WeightedSumExtraction for South face"""
-    subprocess.call([hcl.rscript_path,
-                     "--vanilla",
-                     hcl.WeightedPercentExtraction,
-                     hcl.hidrocl_south,
-                     temporal_raster,
-                     result_file])
-
-
-def write_line(database, result, catchment_names, file_id, file_date, nrow=1):
-    """Write line in dabatabase"""
-    with open(result) as csv_file:
-        csvreader = csv.reader(csv_file, delimiter=',')
-        gauge_id_result = []
-        value_result = []
-        for row in csvreader:
-            gauge_id_result.append(row[0])
-            value_result.append(row[nrow])
-    gauge_id_result = [value for value in gauge_id_result[1:]]
-    value_result = [str(ceil(float(value))) if value.replace('.', '', 1).isdigit() else 'NA' for value in
-                    value_result[1:] if value]
-
-    if catchment_names == gauge_id_result:
-        value_result.insert(0, file_id)
-        value_result.insert(1, file_date)
-        data_line = ','.join(value_result) + '\n'
-        with open(database, 'a') as the_file:
-            the_file.write(data_line)
-    else:
+    if backend == 'python':
+        zonal.weighted_percent_extraction([hcl.hidrocl_south], temporal_raster, [result_file])
+        return
+    run_rscript(hcl.WeightedPercentExtraction, 'percent', hcl.hidrocl_south, temporal_raster, result_file)
+
+
+def extract_mean(mos, tempfolder, name, backend='r', dtype=None):
+    """run weighted mean extraction of a mosaic
+
+    Returns a result file for 'r' and 'python' backends, or a result table
+    for 'memory' backend. dtype is the raster type written for extraction"""
+    if backend == 'memory':
+        if dtype is not None and not is_integer_mosaic(mos):
+            mos = np.trunc(mos)  # same values as writing the raster as integer
+        return zonal.mean_result(hcl.hidrocl_sinusoidal, mos)
+    temporal_raster = os.path.join(tempfolder, name + '.tif')
+    result_file = os.path.join(tempfolder, name + '.csv')
+    write_raster(mos, temporal_raster, dtype)
+    run_WeightedMeanExtraction(temporal_raster, result_file, backend)
+    os.remove(temporal_raster)
+    return result_file
+
+
+def extract_means(mosaics, tempfolder, scene, backend='r', dtypes=None):
+    """run weighted mean extraction of several mosaics of the same scene
+
+    The 'memory' backend computes every mosaic in one zonal pass. Other
+    backends run extract_mean for each mosaic.
+
+    Parameters:
+    mosaics (dict): name -> mosaic
+    tempfolder (str): temporary folder
+    scene (str): scene id, used for temporary file names
+    backend (str): extraction backend
+    dtypes (dict): name -> raster type written for extraction
+
+    Returns:
+    dict: name -> result, as extract_mean"""
+    dtypes = {} if dtypes is None else dtypes
+    if backend == 'memory':
+        rasters = {name: np.trunc(mos) if dtypes.get(name) is not None and not is_integer_mosaic(mos) else mos
+                   for name, mos in mosaics.items()}
+        return zonal.mean_results(hcl.hidrocl_sinusoidal, rasters)
+    return {name: extract_mean(mos, tempfolder, name + '_' + scene, backend, dtypes.get(name))
+            for name, mos in mosaics.items()}
+
+
+def extract_statistics(mos, tempfolder, name, quantiles, backend='python'):
+    """run weighted mean and quantiles extraction of a mosaic in one pass
+
+    Returns a result file (gauge_id, mean, pc, q...) for 'python' backend,
+    or a result table for 'memory' backend"""
+    if backend == 'memory':
+        return zonal.statistics_result(hcl.hidrocl_sinusoidal, mos, quantiles)
+    temporal_raster = os.path.join(tempfolder, name + '.tif')
+    result_file = os.path.join(tempfolder, name + '.csv')
+    write_raster(mos, temporal_raster)
+    zonal.weighted_statistics_extraction(hcl.hidrocl_sinusoidal, temporal_raster, result_file, quantiles)
+    os.remove(temporal_raster)
+    return result_file
+
+
+def extract_percent(mos, tempfolder, name, polygons, backend='python'):
+    """run weighted percent extraction of a mosaic for several polygon layers
+
+    Returns one result file per layer for 'python' backend, or one result
+    table per layer for 'memory' backend"""
+    if backend == 'memory':
+        return zonal.percent_results(polygons, mos)
+    temporal_raster = os.path.join(tempfolder, name + '.tif')
+    result_files = [os.path.join(tempfolder, f'{name}_{i}.csv') for i in range(len(polygons))]
+    write_raster(mos, temporal_raster)
+    zonal.weighted_percent_extraction(polygons, temporal_raster, result_files)
+    os.remove(temporal_raster)
+    return result_files
+
+
+def remove_result(result):
+    """remove result file. In-memory results are left to the garbage collector"""
+    if isinstance(result, str):
+        os.remove(result)
+
+
+def read_result(result, nrow=1):
+    """gauge ids (as text) and values (nan for missing values) of a column of a result
+
+    result is either a result file or an in-memory result table"""
+    if not isinstance(result, pd.DataFrame):
+        result = pd.read_csv(result, dtype=str, keep_default_na=False)
+    return result.iloc[:, 0].astype(str).to_numpy(), storage.numeric_values(result.iloc[:, nrow].to_numpy())
+
+
+def write_line(database, result, catchment_names, file_id, file_date, nrow=1, dtype='int32', writer=None):
+    """Write line in dabatabase
+
+    result is either a result file or an in-memory result table. Values are
+    rounded and checked as dtype values (see hidrocl_storage.format_values).
+    catchment_names can be the gauge_ids array of a HidroCLVariable. With a
+    hidrocl_storage.DatabaseWriter, the line is buffered and written with its batch"""
+    gauge_id_result, values = read_result(result, nrow)
+    value_result = storage.format_values(values, dtype)
+
+    if not np.array_equal(np.asarray(catchment_names, dtype=str), gauge_id_result):
         print('Inconsistencies with gauge ids!')
+    elif writer is not None:
+        writer.add(database, file_id, file_date, value_result)
+    else:
+        storage.open_store(database).append([(file_id, file_date, value_result)])
 
 
-def write_log(log_file, file_id, currenttime, time_dif, database):
+def append_log(log_file, line, writer=None):
+    """append a line to a log file, or buffer it in a hidrocl_storage.DatabaseWriter"""
+    if writer is not None:
+        writer.log(log_file, line)
+    else:
+        with open(log_file, 'a') as txt_file:
+            txt_file.write(line)
+
+
+def write_log(log_file, file_id, currenttime, time_dif, database, writer=None):
     """write log file"""
-    with open(log_file, 'a') as txt_file:
-        txt_file.write(f'ID {file_id}. Date: {currenttime}. Process time: {time_dif} s. Database: {database}. \n')
+    append_log(log_file,
+               f'ID {file_id}. Date: {currenttime}. Process time: {time_dif} s. Database: {database}. \n',
+               writer)
 
 
-def write_log_double(log_file, file_id, currenttime, time_dif, database1, database2):
+def write_log_double(log_file, file_id, currenttime, time_dif, database1, database2, writer=None):
     """write log file for two databases"""
-    with open(log_file, 'a') as txt_file:
-        txt_file.write(
-            f'ID {file_id}. Date: {currenttime}. Process time: {time_dif} s. Databases: {database1}/{database2}. \n')
-
-
-def remove_non_supported_files(product_path):
-    """function for removing non supported files by rioxarray"""
-    files = os.listdir(product_path)
-    for file in files:
-        try:
-            start = time.time()
-            with rioxr.open_rasterio(os.path.join(product_path, file)) as scr:
-                pass
+    append_log(log_file,
+               f'ID {file_id}. Date: {currenttime}. Process time: {time_dif} s. Databases: {database1}/{database2}. \n',
+               writer)
+
+
+def remove_non_supported_files(product_path, workers=4, delete=False):
+    """function for removing files not supported by rasterio
+
+    Files are checked by hidrocl_validation on a pool of processes, and only
+    once while they don't change. Corrupt files are moved to the quarantine
+    folder of the product, or deleted"""
+    return validation.validate_folder(product_path, workers=workers, delete=delete)
+
+
+_scene_extractor = None
+
+
+def init_scene_worker(extractor):
+    """set the extractor of a scene worker process"""
+    global _scene_extractor
+    _scene_extractor = extractor
+    rworker.pool = None  # R sessions of the parent process are not shared with workers
+
+
+def run_scene(extractor, scene, options):
+    """compute a scene with extractor.compute_scene, returning (computed, error) instead of raising"""
+    try:
+        return extractor.compute_scene(scene, **options), None
+    except Exception as error:
+        return None, f'{type(error).__name__}: {error}'
+
+
+def run_scene_worker(scene, options):
+    """compute a scene in a scene worker process"""
+    return run_scene(_scene_extractor, scene, options)
+
+
+def process_scenes(extractor, scenes, workers=1, batch_size=50, **options):
+    """compute scenes and write them in scene order
+
+    Scenes are computed by extractor.compute_scene, in a pool of processes
+    when workers > 1, and written by extractor.write_scene from this process
+    only, so database lines are never interleaved. Lines and logs are
+    buffered and written every batch_size scenes, and when processing ends or
+    fails. Scenes failing to compute or to write are reported and kept in
+    extractor.failed_scenes, and the other scenes go on
+
+    Parameters:
+    extractor: mod13q1extractor, mod10a2extractor or mcd43a3extractor object
+    scenes (list): scenes to process
+    workers (int): processes computing scenes
+    batch_size (int): scenes written at once to each database
+    options: arguments of extractor.compute_scene"""
+    extractor.failed_scenes = {}
+    with ExitStack() as stack:
+        writer = stack.enter_context(storage.DatabaseWriter(batch_size))
+        if workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers,
+                                                               initializer=init_scene_worker,
+                                                               initargs=(extractor,)))
+            # on any exit, scenes not started yet are cancelled instead of computed and thrown away
+            stack.callback(executor.shutdown, wait=True, cancel_futures=True)
+            outputs = executor.map(run_scene_worker, scenes, repeat(options))
+        else:
+            outputs = (run_scene(extractor, scene, options) for scene in scenes)
+        for scene, (computed, error) in zip(scenes, outputs):
+            if error is not None:
+                print(f'Scene {scene} failed: {error}')
+                extractor.failed_scenes[scene] = error
+            elif computed is not None:
+                try:
+                    extractor.write_scene(scene, computed, writer)
+                except Exception as write_error:
+                    error = f'{type(write_error).__name__}: {write_error}'
+                    print(f'Scene {scene} failed: {error}')
+                    extractor.failed_scenes[scene] = error
+                writer.end_scene()
             gc.collect()
-            end = time.time()
-            print(f'opening {file}. Time: {(end - start)}')
-        except:
-            os.remove(os.path.join(product_path, file))
-            end = time.time()
-            print(f'removing {file}. Time: {(end - start)}')
+
+
+def resolve_scene_duplicates(extractor, delete=False):
+    """resolve duplicated granules of an extractor product and update its scene lists
+
+    Parameters:
+    extractor: mod13q1extractor, mod10a2extractor or mcd43a3extractor object
+    delete (bool): delete superseded files instead of moving them to quarantine
+
+    Returns:
+    list: scenes with superseded files"""
+    scenes = catalog.resolve_duplicates(extractor.catalog, delete)
+    if len(scenes) > 0:
+        superseded = set(extractor.product_files) - set(extractor.catalog.names())
+        extractor.product_files = [value for value in extractor.product_files if value not in superseded]
+        extractor.product_ids = extractor.get_product_ids()
+        extractor.all_scenes = extractor.check_product_files()
+        extractor.scenes_occurrences = extractor.count_scenes_occurrences()
+        extractor.incomplete_scenes = extractor.get_incomplete_scenes()
+        extractor.overpopulated_scenes = extractor.get_overpopulated_scenes()
+        extractor.complete_scenes = extractor.get_complete_scenes()
+        extractor.scenes_to_process = extractor.get_scenes_out_of_db()
+    return scenes
 
 
 class HiddenPrints:
@@ -442,17 +771,23 @@ class mod13q1extractor:
     Parameters:
     ndvi (HidroCLVariable): ndvi variable
     evi (HidroCLVariable): evi variable
-    nbr (HidroCLVariable): nbr variable"""
+    nbr (HidroCLVariable): nbr variable
+    threads (int): threads decoding the tiles of a scene
+    memory_budget (int): bytes per mosaic block. If given, mosaics are dask-backed and
+    computed block by block"""
 
-    def __init__(self, ndvi, evi, nbr):
+    def __init__(self, ndvi, evi, nbr, threads=1, memory_budget=None):
         if isinstance(ndvi, HidroCLVariable) & isinstance(evi, HidroCLVariable) & isinstance(nbr, HidroCLVariable):
             self.ndvi = ndvi
             self.evi = evi
             self.nbr = nbr
             self.productname = 'MODIS MOD13Q1 Version 0.61'
             self.productpath = hcl.mod13q1_path
+            self.modis_mosaic = mosaic.ModisMosaic(dtype='int16', footprint=[hcl.hidrocl_sinusoidal],
+                                                   threads=threads, memory_budget=memory_budget)
             self.common_elements = self.compare_indatabase()
             self.product_files = self.read_product_files()
+            self.catalog = catalog.ProductCatalog(self.product_files, self.productpath)
             self.product_ids = self.get_product_ids()
             self.all_scenes = self.check_product_files()
             self.scenes_occurrences = self.count_scenes_occurrences()
@@ -480,72 +815,48 @@ NBR records: {len(self.nbr.indatabase)}.
 NBR database path: {self.nbr.database}
         '''
 
-    def order_indatabase(self):
-        """order indatabase attributes"""
-        if len(self.ndvi.indatabase) > 0:
-            self.ndvi.indatabase.sort()
-        if len(self.evi.indatabase) > 0:
-            self.evi.indatabase.sort()
-        if len(self.nbr.indatabase) > 0:
-            self.nbr.indatabase.sort()
-
     def compare_indatabase(self):
         """compare indatabase and return elements that are equal"""
-        self.order_indatabase()
         if len(self.ndvi.indatabase) > 0 or len(self.evi.indatabase) > 0 or len(self.nbr.indatabase) > 0:
-            common_elements = list(set(self.ndvi.indatabase) & set(self.evi.indatabase) & set(self.nbr.indatabase))
+            common_elements = sorted(self.ndvi.indatabase & self.evi.indatabase & self.nbr.indatabase)
         else:
             common_elements = []
         return common_elements
 
     def read_product_files(self):
-        """read product files"""
-        return [value for value in os.listdir(self.productpath) if '.hdf' in value]
+        """read product files from the file catalog, listing the folder only if it changed"""
+        return catalog.list_files(self.productpath, '.hdf')
 
     def get_product_ids(self):
         """get product ids"""
-        product_ids = [value.split('.')[1] for value in self.product_files]
-        return product_ids
+        return [record.scene for scene in self.catalog.scene_ids() for record in self.catalog.records(scene)]
 
     def check_product_files(self):
         """extract product ids from product files"""
-        files_id = []
-        for product_id in self.product_ids:
-            if product_id not in files_id:
-                files_id.append(product_id)
-        files_id.sort()
-        return files_id
+        return self.catalog.scene_ids()
 
     def count_scenes_occurrences(self):
-        """count self.all_scenes in self.product_ids returning a dictionary"""
-        count_scenes = {}
-        for scene in self.all_scenes:
-            count_scenes[scene] = self.product_ids.count(scene)
-        return count_scenes
+        """count the files of each scene returning a dictionary"""
+        return self.catalog.occurrences()
 
     def get_overpopulated_scenes(self):
-        """get scenes with more than 9 items from self.scenes_occurrences"""
-        overpopulated_scenes = []
-        for scene, occurrences in self.scenes_occurrences.items():
-            if occurrences > 9:
-                overpopulated_scenes.append(scene)
-        return overpopulated_scenes
+        """get scenes with more than 9 items from self.catalog"""
+        return self.catalog.overpopulated_scenes()
 
     def get_incomplete_scenes(self):
-        """get scenes with less than 9 items from self.scenes_occurrences"""
-        incomplete_scenes = []
-        for scene, occurrences in self.scenes_occurrences.items():
-            if occurrences < 9:
-                incomplete_scenes.append(scene)
-        return incomplete_scenes
+        """get scenes with less than 9 items from self.catalog"""
+        return self.catalog.incomplete_scenes()
 
     def get_complete_scenes(self):
-        """get scenes with 9 items from self.scenes_occurrences"""
-        complete_scenes = []
-        for scene, occurrences in self.scenes_occurrences.items():
-            if occurrences == 9:
-                complete_scenes.append(scene)
-        return complete_scenes
+        """get scenes with 9 items from self.catalog"""
+        return self.catalog.complete_scenes()
+
+    def resolve_duplicates(self, delete=False):
+        """keep the newest production of duplicated tiles and process the scenes again
+
+        Superseded files are moved to the quarantine folder of the product
+        (or deleted) and the scenes they completed go back to scenes_to_process"""
+        return resolve_scene_duplicates(self, delete)
 
     def get_scenes_out_of_db(self):
         """compare
@@ -553,14 +864,21 @@ NBR database path: {self.nbr.database}
         self.evi.indatabase and
         self.nbr.indatabase and
         return scenes that are not in the database"""
-        scenes_out_of_db = []
-        for scene in self.complete_scenes:
-            if scene not in self.common_elements:
-                scenes_out_of_db.append(scene)
-        return scenes_out_of_db
+        common_elements = set(self.common_elements)
+        return [scene for scene in self.complete_scenes if scene not in common_elements]
 
-    def run_extraction(self, limit=None):
-        """run scenes to process"""
+    def run_extraction(self, limit=None, backend='r', tile_workers=1, workers=1):
+        """run scenes to process
+
+        Parameters:
+        limit (int): maximum number of scenes to process
+        backend (str): 'r' for Rscript extraction, 'python' for hidrocl_zonal extraction or
+        'memory' for hidrocl_zonal extraction without temporary files or 'tiles' for
+        hidrocl_zonal extraction tile by tile without mosaic.
+        tile_workers (int): processes reducing tiles in parallel for 'tiles' backend
+        workers (int): processes computing scenes in parallel. Lines are written in scene order"""
+
+        check_backend(backend)
 
         with HiddenPrints():
             self.ndvi.checkdatabase()
@@ -572,89 +890,72 @@ NBR database path: {self.nbr.database}
 
         tempfolder = temp_folder()
 
-        scenes_path = [os.path.join(self.productpath, value) for value in self.product_files]
-
         if limit is not None:
             scenes_to_process = self.scenes_to_process[:limit]
         else:
             scenes_to_process = self.scenes_to_process
 
-        for scene in scenes_to_process:
-            if scene not in self.ndvi.indatabase:
-                print(f'Processing scene {scene} for ndvi')
-                r = re.compile('.*' + scene + '.*')
-                selected_files = list(filter(r.match, scenes_path))
-                start = time.time()
-                file_date = datetime.strptime(scene, 'A%Y%j').strftime('%Y-%m-%d')
-                try:
-                    mos = mosaic_raster(selected_files, '250m 16 days NDVI')
-                    mos = mos * 0.1
-                except:
-                    continue
-                temporal_raster = os.path.join(tempfolder, 'ndvi_' + scene + '.tif')
-                result_file = os.path.join(tempfolder, 'ndvi_' + scene + '.csv')
-                mos.rio.to_raster(temporal_raster, compress='LZW')
-                run_WeightedMeanExtraction(temporal_raster, result_file)
-                write_line(self.ndvi.database, result_file, self.ndvi.catchment_names, scene, file_date, nrow=1)
-                write_line(self.ndvi.pcdatabase, result_file, self.ndvi.catchment_names, scene, file_date, nrow=2)
-                end = time.time()
-                time_dif = str(round(end - start))
-                currenttime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                print(f'Time elapsed for {scene}: {str(round(end - start))} seconds')
-                write_log(hcl.log_veg_o_modis_ndvi_mean, scene, currenttime, time_dif, self.ndvi.database)
-                os.remove(temporal_raster)
-                os.remove(result_file)
-                gc.collect()
-            if scene not in self.evi.indatabase:
-                print(f'Processing scene {scene} for evi')
-                r = re.compile('.*' + scene + '.*')
-                selected_files = list(filter(r.match, scenes_path))
-                start = time.time()
-                file_date = datetime.strptime(scene, 'A%Y%j').strftime('%Y-%m-%d')
-                try:
-                    mos = mosaic_raster(selected_files, '250m 16 days EVI')
-                    mos = mos * 0.1
-                except:
-                    continue
-                temporal_raster = os.path.join(tempfolder, 'evi_' + scene + '.tif')
-                result_file = os.path.join(tempfolder, 'evi_' + scene + '.csv')
-                mos.rio.to_raster(temporal_raster, compress='LZW')
-                run_WeightedMeanExtraction(temporal_raster, result_file)
-                write_line(self.evi.database, result_file, self.evi.catchment_names, scene, file_date, nrow=1)
-                write_line(self.evi.pcdatabase, result_file, self.evi.catchment_names, scene, file_date, nrow=2)
-                end = time.time()
-                time_dif = str(round(end - start))
-                currenttime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                print(f'Time elapsed for {scene}: {str(round(end - start))} seconds')
-                write_log(hcl.log_veg_o_modis_evi_mean, scene, currenttime, time_dif, self.evi.database)
-                os.remove(temporal_raster)
-                os.remove(result_file)
-                gc.collect()
-            if scene not in self.nbr.indatabase:
-                print(f'Processing scene {scene} for nbr')
-                r = re.compile('.*' + scene + '.*')
-                selected_files = list(filter(r.match, scenes_path))
-                start = time.time()
-                file_date = datetime.strptime(scene, 'A%Y%j').strftime('%Y-%m-%d')
-                try:
-                    mos = mosaic_nd_raster(selected_files, '250m 16 days NIR reflectance',
-                                           '250m 16 days MIR reflectance')
-                except:
-                    continue
-                temporal_raster = os.path.join(tempfolder, 'nbr_' + scene + '.tif')
-                result_file = os.path.join(tempfolder, 'nbr_' + scene + '.csv')
-                mos.rio.to_raster(temporal_raster, compress='LZW', dtype='int16')
-                run_WeightedMeanExtraction(temporal_raster, result_file)
-                write_line(self.nbr.database, result_file, self.nbr.catchment_names, scene, file_date, nrow=1)
-                write_line(self.nbr.pcdatabase, result_file, self.nbr.catchment_names, scene, file_date, nrow=2)
-                end = time.time()
-                time_dif = str(round(end - start))
-                currenttime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                print(f'Time elapsed for {scene}: {str(round(end - start))} seconds')
-                write_log(hcl.log_veg_o_int_nbr_mean, scene, currenttime, time_dif, self.nbr.database)
-                os.remove(temporal_raster)
-                os.remove(result_file)
-                gc.collect()
+        process_scenes(self, scenes_to_process, workers, tempfolder=tempfolder, backend=backend,
+                       tile_workers=tile_workers)
+
+    def compute_scene(self, scene, tempfolder, backend='r', tile_workers=1):
+        """compute the variables of a scene missing from their databases
+
+        Each tile is opened once and NDVI, EVI, NIR and MIR are read together,
+        then the means of every missing variable are extracted in one pass
+
+        Parameters:
+        scene (str): scene id as AYYYYDDD
+        tempfolder (str): temporary folder
+        backend (str): extraction backend
+        tile_workers (int): processes reducing tiles in parallel for 'tiles' backend
+
+        Returns:
+        dict: result of each variable and process time, or None if the scene is in every database"""
+        variables = [name for name in ('ndvi', 'evi', 'nbr') if scene not in getattr(self, name).indatabase]
+        if len(variables) == 0:
+            return None
+        print(f'Processing scene {scene} for {", ".join(variables)}')
+        selected_files = self.catalog.scene_files(scene)
+        start = time.time()
+        ndvi, evi = '250m 16 days NDVI', '250m 16 days EVI'
+        nir, mir = '250m 16 days NIR reflectance', '250m 16 days MIR reflectance'
+        if backend == 'tiles':
+            products = {'ndvi': ([ndvi], None), 'evi': ([evi], None), 'nbr': ([nir, mir], nbr_values)}
+            scales = {'ndvi': 0.1, 'evi': 0.1, 'nbr': 1}
+            partials = self.modis_mosaic.partials(selected_files, {name: products[name] for name in variables},
+                                                  [hcl.hidrocl_sinusoidal], workers=tile_workers)
+            results = {name: zonal.partials_mean_result(partials[name][0], scales[name]) for name in variables}
+        else:
+            products = {'ndvi': ([ndvi], None), 'evi': ([evi], None), 'nbr': ([nir, mir], mosaic.normalized_difference)}
+            mosaics = self.modis_mosaic.build_products(selected_files, {name: products[name] for name in variables})
+            if 'ndvi' in mosaics:
+                mosaics['ndvi'] = scale_mosaic(mosaics['ndvi'], 0.1)
+            if 'evi' in mosaics:
+                mosaics['evi'] = scale_mosaic(mosaics['evi'], 0.1)
+            if 'nbr' in mosaics:
+                mosaics['nbr'] = mask_nd_mosaic(mosaics['nbr'])
+            results = extract_means(mosaics, tempfolder, scene, backend, {'nbr': 'int16'})
+        return {'results': results, 'time': time.time() - start}
+
+    def write_scene(self, scene, computed, writer=None):
+        """write the results of a scene computed by compute_scene to the databases and logs"""
+        file_date = datetime.strptime(scene, 'A%Y%j').strftime('%Y-%m-%d')
+        logs = {'ndvi': hcl.log_veg_o_modis_ndvi_mean,
+                'evi': hcl.log_veg_o_modis_evi_mean,
+                'nbr': hcl.log_veg_o_int_nbr_mean}
+        for name, result in computed['results'].items():
+            variable = getattr(self, name)
+            write_line(variable.database, result, variable.gauge_ids, scene, file_date, nrow=1,
+                       dtype=variable.dtype, writer=writer)
+            write_line(variable.pcdatabase, result, variable.gauge_ids, scene, file_date, nrow=2,
+                       dtype='int32', writer=writer)
+        time_dif = str(round(computed['time']))
+        currenttime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        print(f'Time elapsed for {scene}: {time_dif} seconds')
+        for name, result in computed['results'].items():
+            write_log(logs[name], scene, currenttime, time_dif, getattr(self, name).database, writer)
+            remove_result(result)
 
 
 class mod10a2extractor:
@@ -662,16 +963,22 @@ class mod10a2extractor:
 
     Parameters:
     nsnow (HidroCLVariable): north face snow
-    ssnow (HidroCLVariable): south face snow"""
+    ssnow (HidroCLVariable): south face snow
+    threads (int): threads decoding the tiles of a scene
+    memory_budget (int): bytes per mosaic block. If given, mosaics are dask-backed and
+    computed block by block"""
 
-    def __init__(self, nsnow, ssnow):
+    def __init__(self, nsnow, ssnow, threads=1, memory_budget=None):
         if isinstance(nsnow, HidroCLVariable) & isinstance(ssnow, HidroCLVariable):
             self.nsnow = nsnow
             self.ssnow = ssnow
             self.productname = 'MODIS MOD10A2 Version 0.61'
             self.productpath = hcl.mod10a2_path
+            self.modis_mosaic = mosaic.ModisMosaic(dtype='uint8', footprint=[hcl.hidrocl_north, hcl.hidrocl_south],
+                                                   threads=threads, memory_budget=memory_budget)
             self.common_elements = self.compare_indatabase()
             self.product_files = self.read_product_files()
+            self.catalog = catalog.ProductCatalog(self.product_files, self.productpath)
             self.product_ids = self.get_product_ids()
             self.all_scenes = self.check_product_files()
             self.scenes_occurrences = self.count_scenes_occurrences()
@@ -696,84 +1003,70 @@ South face snow records: {len(self.ssnow.indatabase)}.
 South face snow database path: {self.ssnow.database}
         '''
 
-    def order_indatabase(self):
-        """order indatabase attributes"""
-        if len(self.nsnow.indatabase) > 0:
-            self.nsnow.indatabase.sort()
-        if len(self.ssnow.indatabase) > 0:
-            self.ssnow.indatabase.sort()
-
     def compare_indatabase(self):
         """compare indatabase and return elements that are equal"""
-        self.order_indatabase()
-        if len(self.nsnow.indatabase) > 0 or len(self.snow.indatabase) > 0:
-            common_elements = list(set(self.nsnow.indatabase) & set(self.ssnow.indatabase))
+        if len(self.nsnow.indatabase) > 0 or len(self.ssnow.indatabase) > 0:
+            common_elements = sorted(self.nsnow.indatabase & self.ssnow.indatabase)
         else:
             common_elements = []
         return common_elements
 
     def read_product_files(self):
-        """read product files"""
-        return [value for value in os.listdir(self.productpath) if '.hdf' in value]
+        """read product files from the file catalog, listing the folder only if it changed"""
+        return catalog.list_files(self.productpath, '.hdf')
 
     def get_product_ids(self):
         """get product ids"""
-        product_ids = [value.split('.')[1] for value in self.product_files]
-        return product_ids
+        return [record.scene for scene in self.catalog.scene_ids() for record in self.catalog.records(scene)]
 
     def check_product_files(self):
         """extract product ids from product files"""
-        files_id = []
-        for product_id in self.product_ids:
-            if product_id not in files_id:
-                files_id.append(product_id)
-        files_id.sort()
-        return files_id
+        return self.catalog.scene_ids()
 
     def count_scenes_occurrences(self):
-        """count self.all_scenes in self.product_ids returning a dictionary"""
-        count_scenes = {}
-        for scene in self.all_scenes:
-            count_scenes[scene] = self.product_ids.count(scene)
-        return count_scenes
+        """count the files of each scene returning a dictionary"""
+        return self.catalog.occurrences()
 
     def get_overpopulated_scenes(self):
-        """get scenes with more than 9 items from self.scenes_occurrences"""
-        overpopulated_scenes = []
-        for scene, occurrences in self.scenes_occurrences.items():
-            if occurrences > 9:
-                overpopulated_scenes.append(scene)
-        return overpopulated_scenes
+        """get scenes with more than 9 items from self.catalog"""
+        return self.catalog.overpopulated_scenes()
 
     def get_incomplete_scenes(self):
-        """get scenes with less than 9 items from self.scenes_occurrences"""
-        incomplete_scenes = []
-        for scene, occurrences in self.scenes_occurrences.items():
-            if occurrences < 9:
-                incomplete_scenes.append(scene)
-        return incomplete_scenes
+        """get scenes with less than 9 items from self.catalog"""
+        return self.catalog.incomplete_scenes()
 
     def get_complete_scenes(self):
-        """get scenes with 9 items from self.scenes_occurrences"""
-        complete_scenes = []
-        for scene, occurrences in self.scenes_occurrences.items():
-            if occurrences == 9:
-                complete_scenes.append(scene)
-        return complete_scenes
+        """get scenes with 9 items from self.catalog"""
+        return self.catalog.complete_scenes()
+
+    def resolve_duplicates(self, delete=False):
+        """keep the newest production of duplicated tiles and process the scenes again
+
+        Superseded files are moved to the quarantine folder of the product
+        (or deleted) and the scenes they completed go back to scenes_to_process"""
+        return resolve_scene_duplicates(self, delete)
 
     def get_scenes_out_of_db(self):
         """compare
         self.nsnow.indatabase and
         self.ssnow.indatabase and
         return scenes that are not in the database"""
-        scenes_out_of_db = []
-        for scene in self.complete_scenes:
-            if scene not in self.common_elements:
-                scenes_out_of_db.append(scene)
-        return scenes_out_of_db
+        common_elements = set(self.common_elements)
+        return [scene for scene in self.complete_scenes if scene not in common_elements]
 
-    def run_extraction(self, limit=None):
-        """run scenes to process"""
+    def run_extraction(self, limit=None, backend='r', tile_workers=1, workers=1):
+        """run scenes to process
+
+        Parameters:
+        limit (int): maximum number of scenes to process
+        backend (str): 'r' for Rscript extraction, 'python' for hidrocl_zonal extraction or
+        'memory' for hidrocl_zonal extraction without temporary files or 'tiles' for
+        hidrocl_zonal extraction tile by tile without mosaic.
+        python, memory and tiles backends get north and south faces from a single read of the snow raster
+        tile_workers (int): processes reducing tiles in parallel for 'tiles' backend
+        workers (int): processes computing scenes in parallel. Lines are written in scene order"""
+
+        check_backend(backend)
 
         with HiddenPrints():
             self.nsnow.checkdatabase()
@@ -783,45 +1076,71 @@ South face snow database path: {self.ssnow.database}
         self.scenes_to_process = self.get_scenes_out_of_db()
 
         tempfolder = temp_folder()
-        scenes_path = [os.path.join(self.productpath, value) for value in self.product_files]
-
         if limit is not None:
             scenes_to_process = self.scenes_to_process[:limit]
         else:
             scenes_to_process = self.scenes_to_process
 
-        for scene in scenes_to_process:
-            if scene not in self.nsnow.indatabase or scene not in self.ssnow.indatabase:
-                print(f'Processing scene {scene} for snow processing')
-                r = re.compile('.*' + scene + '.*')
-                selected_files = list(filter(r.match, scenes_path))
-                start = time.time()
-                file_date = datetime.strptime(scene, 'A%Y%j').strftime('%Y-%m-%d')
-                try:
-                    mos = mosaic_raster(selected_files, 'Maximum_Snow_Extent')
-                    mos = (mos.where(mos == 200) / 200).fillna(0)
-                except:
-                    continue
+        process_scenes(self, scenes_to_process, workers, tempfolder=tempfolder, backend=backend,
+                       tile_workers=tile_workers)
+
+    def compute_scene(self, scene, tempfolder, backend='r', tile_workers=1):
+        """compute the snow percent of north and south faces of a scene
+
+        Parameters:
+        scene (str): scene id as AYYYYDDD
+        tempfolder (str): temporary folder
+        backend (str): extraction backend
+        tile_workers (int): processes reducing tiles in parallel for 'tiles' backend
+
+        Returns:
+        dict: result of each variable and process time, or None if the scene is in both databases"""
+        if scene in self.nsnow.indatabase and scene in self.ssnow.indatabase:
+            return None
+        print(f'Processing scene {scene} for snow processing')
+        selected_files = self.catalog.scene_files(scene)
+        start = time.time()
+        results = {}
+        if backend == 'tiles':
+            partials = self.modis_mosaic.partials(selected_files,
+                                                  {'snow': (['Maximum_Snow_Extent'], snow_values)},
+                                                  [hcl.hidrocl_north, hcl.hidrocl_south],
+                                                  workers=tile_workers)
+            results['nsnow'], results['ssnow'] = [zonal.partials_percent_result(partial)
+                                                  for partial in partials['snow']]
+        else:
+            mos = mosaic_raster(selected_files, 'Maximum_Snow_Extent', self.modis_mosaic)
+            mos = snow_mosaic(mos)
+            if backend == 'r':
                 temporal_raster = os.path.join(tempfolder, 'snow_' + scene + '.tif')
-                mos.rio.to_raster(temporal_raster, compress='LZW')
+                write_raster(mos, temporal_raster)
                 if scene not in self.nsnow.indatabase:
-                    result_file = os.path.join(tempfolder, 'nsnow_' + scene + '.csv')
-                    run_WeightedPercExtractionNorth(temporal_raster, result_file)
-                    write_line(self.nsnow.database, result_file, self.nsnow.catchment_names, scene, file_date, nrow=1)
-                    os.remove(result_file)
+                    results['nsnow'] = os.path.join(tempfolder, 'nsnow_' + scene + '.csv')
+                    run_WeightedPercExtractionNorth(temporal_raster, results['nsnow'])
                 if scene not in self.ssnow.indatabase:
-                    result_file = os.path.join(tempfolder, 'ssnow_' + scene + '.csv')
-                    run_WeightedPercExtractionSouth(temporal_raster, result_file)
-                    write_line(self.ssnow.database, result_file, self.ssnow.catchment_names, scene, file_date, nrow=1)
-                    os.remove(result_file)
-                end = time.time()
-                time_dif = str(round(end - start))
-                currenttime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                print(f'Time elapsed for {scene}: {str(round(end - start))} seconds')
-                write_log_double(hcl.log_snw_o_modis_sca_cum, scene, currenttime, time_dif, self.nsnow.database,
-                                 self.ssnow.database)
+                    results['ssnow'] = os.path.join(tempfolder, 'ssnow_' + scene + '.csv')
+                    run_WeightedPercExtractionSouth(temporal_raster, results['ssnow'])
                 # os.remove(temporal_raster)
-                gc.collect()
+            else:
+                results['nsnow'], results['ssnow'] = extract_percent(mos, tempfolder, 'snow_' + scene,
+                                                                     [hcl.hidrocl_north, hcl.hidrocl_south],
+                                                                     backend)
+        return {'results': results, 'time': time.time() - start}
+
+    def write_scene(self, scene, computed, writer=None):
+        """write the results of a scene computed by compute_scene to the databases and log"""
+        file_date = datetime.strptime(scene, 'A%Y%j').strftime('%Y-%m-%d')
+        for name, result in computed['results'].items():
+            variable = getattr(self, name)
+            if scene not in variable.indatabase:
+                write_line(variable.database, result, variable.gauge_ids, scene, file_date, nrow=1,
+                           dtype=variable.dtype, writer=writer)
+            remove_result(result)
+        time_dif = str(round(computed['time']))
+        currenttime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        print(f'Time elapsed for {scene}: {time_dif} seconds')
+        write_log_double(hcl.log_snw_o_modis_sca_cum, scene, currenttime, time_dif, self.nsnow.database,
+                         self.ssnow.database, writer)
 
 
 class mcd43a3extractor:
@@ -834,9 +1153,15 @@ class mcd43a3extractor:
     albedomedian (HidroCLVariable): mean albedomedian
     albedo75 (HidroCLVariable): mean albedo percentile 75
     albedo90 (HidroCLVariable): mean albedo percentile 90
+    quantiles (tuple): quantiles of albedo10, albedo25, albedomedian, albedo75 and albedo90
+    for the python backend
+    threads (int): threads decoding the tiles of a scene
+    memory_budget (int): bytes per mosaic block. If given, mosaics are dask-backed and
+    computed block by block
     """
 
-    def __init__(self, albedomean, albedo10, albedo25, albedomedian, albedo75, albedo90):
+    def __init__(self, albedomean, albedo10, albedo25, albedomedian, albedo75, albedo90,
+                 quantiles=(0.1, 0.25, 0.5, 0.75, 0.9), threads=1, memory_budget=None):
         if isinstance(albedomean, HidroCLVariable) \
                 & isinstance(albedo10, HidroCLVariable) \
                 & isinstance(albedo25, HidroCLVariable) \
@@ -849,10 +1174,14 @@ class mcd43a3extractor:
             self.albedomedian = albedomedian
             self.albedo75 = albedo75
             self.albedo90 = albedo90
+            self.quantiles = quantiles
             self.productname = 'MODIS MCD43A3 Version 0.61'
             self.productpath = hcl.mcd43a3_path
+            self.modis_mosaic = mosaic.ModisMosaic(dtype='int16', footprint=[hcl.hidrocl_sinusoidal],
+                                                   threads=threads, memory_budget=memory_budget)
             self.common_elements = self.compare_indatabase()
             self.product_files = self.read_product_files()
+            self.catalog = catalog.ProductCatalog(self.product_files, self.productpath)
             self.product_ids = self.get_product_ids()
             self.all_scenes = self.check_product_files()
             self.scenes_occurrences = self.count_scenes_occurrences()
@@ -889,88 +1218,58 @@ Albedo p90 records: {len(self.albedo90.indatabase)}.
 Albedo p90 path: {self.albedo90.database}
         '''
 
-    def order_indatabase(self):
-        """order indatabase attributes"""
-        if len(self.albedomean.indatabase) > 0:
-            self.albedomean.indatabase.sort()
-        if len(self.albedo10.indatabase) > 0:
-            self.albedo10.indatabase.sort()
-        if len(self.albedo25.indatabase) > 0:
-            self.albedo25.indatabase.sort()
-        if len(self.albedomedian.indatabase) > 0:
-            self.albedomedian.indatabase.sort()
-        if len(self.albedo75.indatabase) > 0:
-            self.albedo75.indatabase.sort()
-        if len(self.albedo90.indatabase) > 0:
-            self.albedo90.indatabase.sort()
-
     def compare_indatabase(self):
         """compare indatabase and return elements that are equal"""
-        self.order_indatabase()
         if len(self.albedomean.indatabase) > 0 \
                 or len(self.albedo10.indatabase) > 0 \
                 or len(self.albedo25.indatabase) > 0 \
                 or len(self.albedomedian.indatabase) > 0 \
                 or len(self.albedo75.indatabase) > 0 \
                 or len(self.albedo90.indatabase) > 0:
-            common_elements = list(set(self.albedomean.indatabase) \
-                                   & set(self.albedo10.indatabase) \
-                                   & set(self.albedo25.indatabase) \
-                                   & set(self.albedomedian.indatabase) \
-                                   & set(self.albedo75.indatabase) \
-                                   & set(self.albedo90.indatabase))
+            common_elements = sorted(self.albedomean.indatabase
+                                     & self.albedo10.indatabase
+                                     & self.albedo25.indatabase
+                                     & self.albedomedian.indatabase
+                                     & self.albedo75.indatabase
+                                     & self.albedo90.indatabase)
         else:
             common_elements = []
         return common_elements
 
     def read_product_files(self):
-        """read product files"""
-        return [value for value in os.listdir(self.productpath) if '.hdf' in value]
+        """read product files from the file catalog, listing the folder only if it changed"""
+        return catalog.list_files(self.productpath, '.hdf')
 
     def get_product_ids(self):
         """get product ids"""
-        product_ids = [value.split('.')[1] for value in self.product_files]
-        return product_ids
+        return [record.scene for scene in self.catalog.scene_ids() for record in self.catalog.records(scene)]
 
     def check_product_files(self):
         """extract product ids from product files"""
-        files_id = []
-        for product_id in self.product_ids:
-            if product_id not in files_id:
-                files_id.append(product_id)
-        files_id.sort()
-        return files_id
+        return self.catalog.scene_ids()
 
     def count_scenes_occurrences(self):
-        """count self.all_scenes in self.product_ids returning a dictionary"""
-        count_scenes = {}
-        for scene in self.all_scenes:
-            count_scenes[scene] = self.product_ids.count(scene)
-        return count_scenes
+        """count the files of each scene returning a dictionary"""
+        return self.catalog.occurrences()
 
     def get_overpopulated_scenes(self):
-        """get scenes with more than 9 items from self.scenes_occurrences"""
-        overpopulated_scenes = []
-        for scene, occurrences in self.scenes_occurrences.items():
-            if occurrences > 9:
-                overpopulated_scenes.append(scene)
-        return overpopulated_scenes
+        """get scenes with more than 9 items from self.catalog"""
+        return self.catalog.overpopulated_scenes()
 
     def get_incomplete_scenes(self):
-        """get scenes with less than 9 items from self.scenes_occurrences"""
-        incomplete_scenes = []
-        for scene, occurrences in self.scenes_occurrences.items():
-            if occurrences < 9:
-                incomplete_scenes.append(scene)
-        return incomplete_scenes
+        """get scenes with less than 9 items from self.catalog"""
+        return self.catalog.incomplete_scenes()
 
     def get_complete_scenes(self):
-        """get scenes with 9 items from self.scenes_occurrences"""
-        complete_scenes = []
-        for scene, occurrences in self.scenes_occurrences.items():
-            if occurrences == 9:
-                complete_scenes.append(scene)
-        return complete_scenes
+        """get scenes with 9 items from self.catalog"""
+        return self.catalog.complete_scenes()
+
+    def resolve_duplicates(self, delete=False):
+        """keep the newest production of duplicated tiles and process the scenes again
+
+        Superseded files are moved to the quarantine folder of the product
+        (or deleted) and the scenes they completed go back to scenes_to_process"""
+        return resolve_scene_duplicates(self, delete)
 
     def get_scenes_out_of_db(self):
         """compare
@@ -981,14 +1280,22 @@ Albedo p90 path: {self.albedo90.database}
         self.albedo75.indatabase and
         self.albedo90.indatabase
         return scenes that are not in the database"""
-        scenes_out_of_db = []
-        for scene in self.complete_scenes:
-            if scene not in self.common_elements:
-                scenes_out_of_db.append(scene)
-        return scenes_out_of_db
+        common_elements = set(self.common_elements)
+        return [scene for scene in self.complete_scenes if scene not in common_elements]
 
-    def run_extraction(self, limit=None):
-        """run scenes to process"""
+    def run_extraction(self, limit=None, backend='r', tile_workers=1, workers=1):
+        """run scenes to process
+
+        Parameters:
+        limit (int): maximum number of scenes to process
+        backend (str): 'r' for Rscript extraction, 'python' for hidrocl_zonal extraction or
+        'memory' for hidrocl_zonal extraction without temporary files or 'tiles' for
+        hidrocl_zonal extraction tile by tile without mosaic.
+        python, memory and tiles backends compute mean and quantiles in one pass
+        tile_workers (int): processes reducing tiles in parallel for 'tiles' backend
+        workers (int): processes computing scenes in parallel. Lines are written in scene order"""
+
+        check_backend(backend)
 
         with HiddenPrints():
             self.albedomean.checkdatabase()
@@ -1003,90 +1310,85 @@ Albedo p90 path: {self.albedo90.database}
 
         tempfolder = temp_folder()
 
-        scenes_path = [os.path.join(self.productpath, value) for value in self.product_files]
-
         if limit is not None:
             scenes_to_process = self.scenes_to_process[:limit]
         else:
             scenes_to_process = self.scenes_to_process
 
-        for scene in scenes_to_process:
-            if scene not in self.albedomean.indatabase \
-                    or scene not in self.albedo10.indatabase \
-                    or scene not in self.albedo25.indatabase \
-                    or scene not in self.albedomedian.indatabase \
-                    or scene not in self.albedo75.indatabase \
-                    or scene not in self.albedo90.indatabase:
-                print(f'Processing scene {scene} for albedo processing')
-                r = re.compile('.*' + scene + '.*')
-                selected_files = list(filter(r.match, scenes_path))
-                start = time.time()
-                file_date = datetime.strptime(scene, 'A%Y%j').strftime('%Y-%m-%d')
-                try:
-                    mos = mosaic_raster(selected_files, 'Albedo_BSA_vis')
-                    mos = mos * 0.1
-                except:
-                    continue
-                temporal_raster = os.path.join(tempfolder, 'albedo_' + scene + '.tif')
-                mos.rio.to_raster(temporal_raster, compress='LZW')
-
-                if scene not in self.albedomean.indatabase:
-                    result_file = os.path.join(tempfolder, 'albedomean_' + scene + '.csv')
-                    run_WeightedMeanExtraction(temporal_raster, result_file)
-                    write_line(self.albedomean.database, result_file, self.albedomean.catchment_names, scene, file_date,
-                               nrow=1)
-                    'first done'
-                    os.remove(result_file)
-
-                if scene not in self.albedo10.indatabase \
-                        or scene not in self.albedo25.indatabase \
-                        or scene not in self.albedomedian.indatabase \
-                        or scene not in self.albedo75.indatabase \
-                        or scene not in self.albedo90.indatabase:
-                    result_file = os.path.join(tempfolder, 'albedoq_' + scene + '.csv')
-                    run_WeightedQuanExtraction(temporal_raster, result_file)
-                    if scene not in self.albedo10.indatabase:
-                        write_line(self.albedo10.database, result_file, self.albedo10.catchment_names, scene, file_date,
-                                   nrow=1)
-                    if scene not in self.albedo25.indatabase:
-                        write_line(self.albedo25.database, result_file, self.albedo25.catchment_names, scene, file_date,
-                                   nrow=2)
-                    if scene not in self.albedomedian.indatabase:
-                        write_line(self.albedomedian.database, result_file, self.albedomedian.catchment_names, scene,
-                                   file_date, nrow=3)
-                    if scene not in self.albedo75.indatabase:
-                        write_line(self.albedo75.database, result_file, self.albedo75.catchment_names, scene, file_date,
-                                   nrow=4)
-                    if scene not in self.albedo90.indatabase:
-                        write_line(self.albedo90.database, result_file, self.albedo90.catchment_names, scene, file_date,
-                                   nrow=5)
-                    'second done'
-                    os.remove(result_file)
-
-                end = time.time()
-                time_dif = str(round(end - start))
-                currenttime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                print(f'Time elapsed for {scene}: {str(round(end - start))} seconds')
-                if scene not in self.albedomean.indatabase:
-                    write_log(hcl.log_sun_o_modis_al_mean_b_d16_p0d, scene, currenttime, time_dif,
-                              self.albedomean.database)
-                if scene not in self.albedo10.indatabase:
-                    write_log(hcl.log_sun_o_modis_al_p10_b_d16_p0d, scene, currenttime, time_dif,
-                              self.albedo10.database)
-                if scene not in self.albedo25.indatabase:
-                    write_log(hcl.log_sun_o_modis_al_p25_b_d16_p0d, scene, currenttime, time_dif,
-                              self.albedo25.database)
-                if scene not in self.albedomedian.indatabase:
-                    write_log(hcl.log_sun_o_modis_al_median_b_d16_p0d, scene, currenttime, time_dif,
-                              self.albedomedian.database)
-                if scene not in self.albedo75.indatabase:
-                    write_log(hcl.log_sun_o_modis_al_p75_b_d16_p0d, scene, currenttime, time_dif,
-                              self.albedo75.database)
-                if scene not in self.albedo90.indatabase:
-                    write_log(hcl.log_sun_o_modis_al_p90_b_d16_p0d, scene, currenttime, time_dif,
-                              self.albedo90.database)
-                os.remove(temporal_raster)
-                gc.collect()
+        process_scenes(self, scenes_to_process, workers, tempfolder=tempfolder, backend=backend,
+                       tile_workers=tile_workers)
+
+    def compute_scene(self, scene, tempfolder, backend='r', tile_workers=1):
+        """compute the albedo mean and quantiles of a scene missing from their databases
+
+        Parameters:
+        scene (str): scene id as AYYYYDDD
+        tempfolder (str): temporary folder
+        backend (str): extraction backend
+        tile_workers (int): processes reducing tiles in parallel for 'tiles' backend
+
+        Returns:
+        dict: (variable, result, column) lines, results and process time, or None if the scene
+        is in every database"""
+        names = ['albedomean', 'albedo10', 'albedo25', 'albedomedian', 'albedo75', 'albedo90']
+        missing = [name for name in names if scene not in getattr(self, name).indatabase]
+        if len(missing) == 0:
+            return None
+        print(f'Processing scene {scene} for albedo processing')
+        selected_files = self.catalog.scene_files(scene)
+        start = time.time()
+        if backend == 'r':
+            mos = scale_mosaic(mosaic_raster(selected_files, 'Albedo_BSA_vis', self.modis_mosaic), 0.1)
+            temporal_raster = os.path.join(tempfolder, 'albedo_' + scene + '.tif')
+            write_raster(mos, temporal_raster)
+            lines, results = [], []
+            if 'albedomean' in missing:
+                result_file = os.path.join(tempfolder, 'albedomean_' + scene + '.csv')
+                run_WeightedMeanExtraction(temporal_raster, result_file, backend)
+                lines.append(('albedomean', result_file, 1))
+                results.append(result_file)
+            if any(name in missing for name in names[1:]):
+                result_file = os.path.join(tempfolder, 'albedoq_' + scene + '.csv')
+                run_WeightedQuanExtraction(temporal_raster, result_file)
+                lines += [(name, result_file, nrow) for nrow, name in enumerate(names[1:], start=1)
+                          if name in missing]
+                results.append(result_file)
+            os.remove(temporal_raster)
+        else:
+            if backend == 'tiles':
+                partials = self.modis_mosaic.partials(selected_files,
+                                                      {'albedo': (['Albedo_BSA_vis'], None)},
+                                                      [hcl.hidrocl_sinusoidal], sketch=True,
+                                                      workers=tile_workers)
+                result = zonal.partials_statistics_result(partials['albedo'][0], self.quantiles, 0.1)
+            else:
+                mos = scale_mosaic(mosaic_raster(selected_files, 'Albedo_BSA_vis', self.modis_mosaic), 0.1)
+                result = extract_statistics(mos, tempfolder, 'albedo_' + scene, self.quantiles, backend)
+            # gauge_id, mean, pc and one column per quantile
+            lines = [(name, result, nrow) for name, nrow in zip(names, [1, 3, 4, 5, 6, 7]) if name in missing]
+            results = [result]
+        return {'lines': lines, 'results': results, 'time': time.time() - start}
+
+    def write_scene(self, scene, computed, writer=None):
+        """write the results of a scene computed by compute_scene to the databases and logs"""
+        file_date = datetime.strptime(scene, 'A%Y%j').strftime('%Y-%m-%d')
+        logs = {'albedomean': hcl.log_sun_o_modis_al_mean_b_d16_p0d,
+                'albedo10': hcl.log_sun_o_modis_al_p10_b_d16_p0d,
+                'albedo25': hcl.log_sun_o_modis_al_p25_b_d16_p0d,
+                'albedomedian': hcl.log_sun_o_modis_al_median_b_d16_p0d,
+                'albedo75': hcl.log_sun_o_modis_al_p75_b_d16_p0d,
+                'albedo90': hcl.log_sun_o_modis_al_p90_b_d16_p0d}
+        for name, result, nrow in computed['lines']:
+            variable = getattr(self, name)
+            write_line(variable.database, result, variable.gauge_ids, scene, file_date, nrow=nrow,
+                       dtype=variable.dtype, writer=writer)
+        for result in computed['results']:
+            remove_result(result)
+        time_dif = str(round(computed['time']))
+        currenttime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        print(f'Time elapsed for {scene}: {time_dif} seconds')
+        for name, result, nrow in computed['lines']:
+            write_log(logs[name], scene, currenttime, time_dif, getattr(self, name).database, writer)
 
 
 class gldas_noah:
@@ -1132,20 +1434,10 @@ NBR records: {len(self.nbr.indatabase)}.
 NBR database path: {self.nbr.database}
         '''
 
-    def order_indatabase(self):
-        """order indatabase attributes"""
-        if len(self.ndvi.indatabase) > 0:
-            self.ndvi.indatabase.sort()
-        if len(self.evi.indatabase) > 0:
-            self.evi.indatabase.sort()
-        if len(self.nbr.indatabase) > 0:
-            self.nbr.indatabase.sort()
-
     def compare_indatabase(self):
         """compare indatabase and return elements that are equal"""
-        self.order_indatabase()
         if len(self.ndvi.indatabase) > 0 or len(self.evi.indatabase) > 0 or len(self.nbr.indatabase) > 0:
-            common_elements = list(set(self.ndvi.indatabase) & set(self.evi.indatabase) & set(self.nbr.indatabase))
+            common_elements = sorted(self.ndvi.indatabase & self.evi.indatabase & self.nbr.indatabase)
         else:
             common_elements = []
         return common_elements
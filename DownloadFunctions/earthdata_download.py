@@ -26,6 +26,12 @@ from datetime import datetime
 from datetime import timedelta
 import argparse
 
+try:
+    # file catalog of Class tests, if it is in the python path
+    import hidrocl_catalog
+except ImportError:
+    hidrocl_catalog = None
+
 grids = ['h13v14','h14v14','h12v13','h13v13','h11v12',
     'h12v12','h11v11','h12v11','h11v10']
 
@@ -122,21 +128,28 @@ if __name__ == '__main__':
 
     if os.path.exists(database_path):
         print(f'Checking folder {database_path}')
-        files = os.listdir(database_path)
-        if(ed_opt == 'landdata'):
-            dates = [datetime.strptime(value.lower().split('.')[1], 'a%Y%m%d') for value in files if file_extension in value.lower()]
-        elif(ed_opt == 'precipitation'):
-            dates = [datetime.strptime(value.lower().split('.')[4].split('-')[0], '%Y%m%d') for value in files if file_extension in value.lower()]
+        if hidrocl_catalog is not None:
+            # most recent scene date from the file catalog
+            with hidrocl_catalog.FileCatalog() as files_catalog:
+                recent_date = files_catalog.latest_date(database_path, file_extension)
+            if recent_date is not None:
+                recent_date = datetime.strptime(recent_date, '%Y-%m-%d')
         else:
-            dates = [datetime.strptime(value.lower().split('.')[1], 'a%Y%j') for value in files if file_extension in value.lower()]
-        if len(dates) >= 1:
-            recent_date = max(dates)
-            print(f'Found {len(dates)} files. The most recent date is {recent_date.strftime("%Y-%m-%d")}')
+            files = os.listdir(database_path)
+            if(ed_opt == 'landdata'):
+                dates = [datetime.strptime(value.lower().split('.')[1], 'a%Y%m%d') for value in files if file_extension in value.lower()]
+            elif(ed_opt == 'precipitation'):
+                dates = [datetime.strptime(value.lower().split('.')[4].split('-')[0], '%Y%m%d') for value in files if file_extension in value.lower()]
+            else:
+                dates = [datetime.strptime(value.lower().split('.')[1], 'a%Y%j') for value in files if file_extension in value.lower()]
+            recent_date = max(dates) if len(dates) >= 1 else None
+        if recent_date is not None:
+            print(f'The most recent date is {recent_date.strftime("%Y-%m-%d")}')
             recent_date = recent_date - timedelta(16)
             recent_date = recent_date.strftime("%Y-%m-%d")
         else:
             recent_date = '2000-01-01'
-            print(f'Found {len(dates)} files.')
+            print('No files found.')
         if start_date is None:
             start_date = recent_date
         print(f'Setting period from {start_date} to {end_date}')
@@ -182,6 +195,9 @@ if __name__ == '__main__':
             store = Store(auth)
 
             store.get(download_links, database_path, threads = threads)
+            if hidrocl_catalog is not None:
+                with hidrocl_catalog.FileCatalog() as files_catalog:
+                    files_catalog.update(database_path)
         except KeyboardInterrupt:
             print('Interrupted by keyboard')
         except:
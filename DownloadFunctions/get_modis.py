@@ -24,10 +24,15 @@ import json # for json data management
 import subprocess # needed for downloading modis data
 # wget should be installed, not the python library
 from functools import reduce # url path join
-from os.path import exists # check if file exists
+from os.path import exists, dirname # check if file exists, folder of a file
 from os import listdir # for listing directories in a path
 import argparse # for arguments into the function
 
+try:
+    import hidrocl_catalog # file catalog of Class tests, if it is in the python path
+except ImportError:
+    hidrocl_catalog = None
+
 def join_slash(a, b):
     return a.rstrip('/') + '/' + b.lstrip('/')
 def urljoin(*args):
@@ -148,12 +153,18 @@ if __name__ == '__main__':
                         if exists(file_temp):
                             print('File '+file_temp+' is already downloaded')
                         else:
+                            if hidrocl_catalog is not None:
+                                with hidrocl_catalog.FileCatalog() as files_catalog:
+                                    folder_mtime = files_catalog.folder_mtime(dirname(file_temp))
                             command = ['wget.exe','-e robots=off','-m','-np','-R','.html,.tmp','-nH','--cut-dirs=3',
                                               url4,token,'-P',
                                               path]
                             p = subprocess.Popen(command, stdout=subprocess.PIPE)
                             stdout, stderr = p.communicate()
                             p.wait()
+                            if hidrocl_catalog is not None and exists(file_temp):
+                                with hidrocl_catalog.FileCatalog() as files_catalog:
+                                    files_catalog.add_file(file_temp, folder_mtime)
             print('Download completed!')
     try:
         get_modis(mod_opt, path)
@@ -27,6 +27,12 @@ import time
 
 import hidrocl_paths
 
+try:
+    # file catalog of Class tests, if it is in the python path
+    import hidrocl_catalog
+except ImportError:
+    hidrocl_catalog = None
+
 product_path = hidrocl_paths.pdirnow
 
 ftp_server = 'persiann.eng.uci.edu'
@@ -46,18 +52,28 @@ while True:
 dir_list = []
 ftp.dir(dir_list.append)
 files_list = [value.split(' ')[-1] for value in dir_list if 'bin' in value]
-files_list = [value for value in files_list if value.split('.gz')[0] not in os.listdir(product_path)]
+if hidrocl_catalog is not None:
+    files_catalog = hidrocl_catalog.FileCatalog()
+    downloaded = set(files_catalog.files(product_path))
+else:
+    files_catalog = None
+    downloaded = set(os.listdir(product_path))
+files_list = [value for value in files_list if value.split('.gz')[0] not in downloaded]
 
 while True:
     try:
         for file_name in files_list:
             print(f'Downloading {file_name}')
+            if files_catalog is not None:
+                folder_mtime = files_catalog.folder_mtime(product_path)
             wget.download(f'ftp://{ftp_server}/{ftp_path}/{file_name}', out=product_path)
             print(f'Unzipping {file_name}')
             with gzip.open(f'{product_path}/{file_name}', 'rb') as f_in:
                 with open(f'{product_path}/{file_name.split(".gz")[0]}', 'wb') as f_out:
                     shutil.copyfileobj(f_in, f_out)
             os.remove(f'{product_path}/{file_name}')
+            if files_catalog is not None:
+                files_catalog.add_file(f'{product_path}/{file_name.split(".gz")[0]}', folder_mtime)
         break
     except:
         print('FTP connection failed. Trying again in 5 seconds...')
@@ -67,4 +83,6 @@ while True:
         ftp.login()
         ftp.cwd(ftp_path)
         continue
-ftp.close()
\ No newline at end of file
+ftp.close()
+if files_catalog is not None:
+    files_catalog.close()
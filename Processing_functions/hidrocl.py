@@ -22,8 +22,21 @@
 from pathlib import Path
 import os
 import csv
-from math import ceil
-import re
+import numpy as np
+import pandas as pd
+
+try:
+    # file catalog of Class tests, if it is in the python path
+    import hidrocl_catalog
+except ImportError:
+    hidrocl_catalog = None
+
+try:
+    # storage backends of Class tests, with the sidecar index of the databases
+    # and the NA and rounding rules of their values
+    import hidrocl_storage
+except ImportError:
+    hidrocl_storage = None
 
 
 def temp_folder():
@@ -44,12 +57,15 @@ def temp_folder():
 
 
 def database_check(db_path, id_name, catchment_names):
-    """Check or create database. Then pull IDs"""
+    """Check or create database. Then pull IDs as a set"""
 
     if os.path.exists(db_path): # check if db exists
         print('Database found, using ' + db_path)
+        if hidrocl_storage is not None:
+            # ids from the sidecar index, without reading the whole database
+            return hidrocl_storage.IdIndex(db_path).ids() | {id_name}
         with open(db_path, 'r') as the_file:
-            ids_in_db = [row[0] for row in csv.reader(the_file,delimiter=',')]
+            ids_in_db = {row[0] for row in csv.reader(the_file,delimiter=',')}
     else: # create db
         print('Database not found, creating it for ' + db_path)
         header_line = [str(s) for s in catchment_names]
@@ -58,24 +74,27 @@ def database_check(db_path, id_name, catchment_names):
         header_line  = ','.join(header_line) + '\n'
         with open(db_path,'w') as the_file:
             the_file.write(header_line)
-        ids_in_db = [id_name]
+        ids_in_db = {id_name}
 
     return(ids_in_db)
 
-def write_line(db_path, result, catchment_names, file_id, file_date, nrow = 1):
-    """Write line in dabatabase"""
-
-    with open(result) as csv_file:
-        csvreader = csv.reader(csv_file, delimiter=',')
-        gauge_id_result = []
-        value_result = []
-        for row in csvreader:
-                gauge_id_result.append(row[0])
-                value_result.append(row[nrow])
-    gauge_id_result = [int(value) for value in gauge_id_result[1:]]
-    value_result = [str(ceil(float(value))) if value.replace('.','',1).isdigit() else 'NA' for value in value_result[1:] if value]
+def format_values(values, dtype = 'int32'):
+    """Values as database text, NA for missing values, with the rules of
+    hidrocl_storage.format_values. Without Class tests in the python path,
+    values are rounded up as integers"""
+    if hidrocl_storage is not None:
+        return hidrocl_storage.format_values(values, dtype)
+    values = np.ceil(np.asarray(values, dtype = 'float64'))
+    return [str(int(value)) if np.isfinite(value) else 'NA' for value in values]
+
+def write_line(db_path, result, catchment_names, file_id, file_date, nrow = 1, dtype = 'int32'):
+    """Write line in dabatabase. The result column is parsed at once, negative values included"""
+
+    table = pd.read_csv(result, dtype = str, keep_default_na = False)
+    gauge_id_result = pd.to_numeric(table.iloc[:, 0], errors = 'coerce').to_numpy()
+    value_result = format_values(pd.to_numeric(table.iloc[:, nrow], errors = 'coerce'), dtype)
     
-    if(catchment_names == gauge_id_result):
+    if np.array_equal(np.asarray(catchment_names), gauge_id_result):
         value_result.insert(0,file_id)
         value_result.insert(1,file_date)
         data_line  = ','.join(value_result) + '\n'
@@ -84,22 +103,41 @@ def write_line(db_path, result, catchment_names, file_id, file_date, nrow = 1):
     else:
         print('Inconsistencies with gauge ids!')
 
-def remove_duplicates(main_path):
-    """Remove duplicate hdf5 files from folder"""
-    files = os.listdir(main_path)
-    raw_files = [value for value in os.listdir(main_path) if '.hdf' in value]
-    raw_ids = [value.split('.')[1] for value in raw_files]
-    files_id = []
-    for raw_id in raw_ids:
-        if raw_id not in files_id:
-            files_id.append(raw_id)
-    files_id.sort()
-    for file_id in files_id:
-        r = re.compile('.*'+file_id+'.*')
-        selected_files = list(filter(r.match, raw_files))
-        if(len(selected_files)>9):
-            print(f'More than 9 files for {file_id}')
-            print(selected_files)
-            """waiting a real case"""
-        else:
-            print(f'{len(selected_files)} files for {file_id}')
\ No newline at end of file
+def list_files(main_path, extension):
+    """List product files with extension in a folder, from the file catalog if available"""
+    if hidrocl_catalog is not None:
+        return hidrocl_catalog.list_files(main_path, extension)
+    return [value for value in os.listdir(main_path) if extension in value]
+
+def remove_duplicates(main_path, delete=False):
+    """Keep the newest production of each scene and tile in a MODIS folder
+
+    Superseded granules (same scene and tile with an older production
+    timestamp) are moved to main_path/quarantine, or deleted. Returns the
+    scenes with superseded files, which can be processed again"""
+    if hidrocl_catalog is not None:
+        return hidrocl_catalog.resolve_folder_duplicates(main_path, delete)
+    newest = {}
+    superseded = []
+    for raw_file in list_files(main_path, '.hdf'):
+        parts = raw_file.split('.')
+        if len(parts) < 6:
+            continue
+        key = (parts[0], parts[1], parts[2], '.'.join(parts[5:]))
+        if key not in newest:
+            newest[key] = raw_file
+            continue
+        older, newer = sorted([newest[key], raw_file], key=lambda value: value.split('.')[4])
+        superseded.append(older)
+        newest[key] = newer
+    if len(superseded) >= 1:
+        quarantine_path = os.path.join(main_path, 'quarantine')
+        os.makedirs(quarantine_path, exist_ok=True)
+        for raw_file in superseded:
+            if delete:
+                os.remove(os.path.join(main_path, raw_file))
+            else:
+                os.replace(os.path.join(main_path, raw_file), os.path.join(quarantine_path, raw_file))
+    scenes = sorted(set(value.split('.')[1] for value in superseded))
+    print(f'{len(superseded)} superseded files in {len(scenes)} scenes of {main_path}')
+    return scenes
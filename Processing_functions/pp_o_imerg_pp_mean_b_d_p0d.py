@@ -57,7 +57,7 @@ imerg_in_db = hidrocl.database_check(db_path = database_path,
     id_name = 'imerg_id',
     catchment_names = gauges)
     
-raw_files = [value for value in os.listdir(main_path) if '.HDF5' in value]
+raw_files = hidrocl.list_files(main_path, '.HDF5')
 raw_ids = [value.split('.')[4].split('-')[0] for value in raw_files]
 
 if len(raw_files) >= 1:
@@ -89,7 +89,7 @@ modis_in_db = hidrocl.database_check(db_path = database_albedop90,
     id_name = 'modis_id',
     catchment_names = gauges)
     
-raw_files = [value for value in os.listdir(main_path) if '.hdf' in value]
+raw_files = hidrocl.list_files(main_path, '.hdf')
 raw_ids = [value.split('.')[1] for value in raw_files]
 
 if len(raw_files) >= 1: